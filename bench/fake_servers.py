@@ -0,0 +1,493 @@
+# Локальные заглушки Elasticsearch, Kibana и Keycloak для бенчмарков (bench/run_bench.py).
+# Один HTTP-сервер обслуживает все три API: пути не пересекаются, поэтому скрипты можно
+# направить на один адрес (ES_HOST, KIBANA_HOST, KEYCLOAK_URL). Реализовано только то,
+# чем пользуются скрипты репозитория; каждый запрос считается по (API, метод, маршрут).
+
+import fnmatch
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+# Данные всех трёх сервисов в памяти и счётчик запросов
+class FakeState:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.requests = Counter()
+        # Маршруты (метод, шаблон пути из ROUTES), которые отвечают 500 - проверка обработки сбоев
+        self.fail_routes = set()
+        # ES
+        self.ilm = {}
+        self.templates = {}
+        self.component_templates = {}
+        self.indices = {}          # имя -> {"aliases": {алиас: {...}}, "created": мс, "size": байт}
+        self.roles = {}
+        self.role_mappings = {}
+        # Kibana
+        self.saved_objects = {}    # (type, id) -> attributes
+        # Keycloak
+        self.realms = {"master": {"id": "master", "realm": "master"}}
+        self.groups = {}           # realm -> {id: группа}, см. _realm_groups
+        self.group_paths = {}      # realm -> {path: id}
+        self.kc_roles = {}         # realm -> {name: {"id","name"}}
+        # True - поиск групп (?search=) отдаёт найденные группы с заполненным поддеревом subGroups;
+        # False - как списки групп, только subGroupCount (подгруппы читаются через /children)
+        self.search_subtree = True
+
+    def count(self, family, method, path):
+        with self.lock:
+            self.requests[(family, method, path)] += 1
+
+    def total(self, family=None, method=None):
+        return sum(v for (f, m, _), v in self.requests.items()
+                   if (family is None or f == family) and (method is None or m == method))
+
+    def reset_counts(self):
+        with self.lock:
+            self.requests.clear()
+
+
+# === HTTP-обработчик: ищет маршрут в ROUTES и вызывает его под общим замком ===
+def _handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Буферизуем ответ целиком, иначе заголовки и тело уходят отдельными пакетами
+        wbufsize = 65536
+
+        def log_message(self, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if not raw:
+                return None
+            ctype = self.headers.get("Content-Type", "")
+            if "x-www-form-urlencoded" in ctype:
+                return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+            return json.loads(raw)
+
+        def _send(self, status, body=None, headers=None):
+            data = b"" if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("X-Elastic-Product", "Elasticsearch")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _dispatch(self, method):
+            if state.latency:
+                time.sleep(state.latency)
+            url = urlparse(self.path)
+            # Маршруты сопоставляются с путём как есть (имя роли может содержать закодированный '/')
+            path = url.path
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            body = self._body()
+            for family, pattern, fn in ROUTES:
+                if pattern[0] != method:
+                    continue
+                m = re.fullmatch(pattern[1], path)
+                if m:
+                    state.count(family, method, pattern[1])
+                    if pattern in state.fail_routes:
+                        return self._send(500, {"error": {"type": "bench_injected_failure", "reason": "injected"},
+                                                "status": 500})
+                    with state.lock:
+                        result = fn(state, query, body, *(unquote(group) for group in m.groups()))
+                    status, payload = result[0], result[1]
+                    headers = result[2] if len(result) > 2 else None
+                    return self._send(status, payload, headers)
+            state.count("unknown", method, path)
+            self._send(404, {"error": f"no route {method} {path}"})
+
+        def do_GET(self):
+            self._dispatch("GET")
+
+        def do_PUT(self):
+            self._dispatch("PUT")
+
+        def do_POST(self):
+            self._dispatch("POST")
+
+        def do_DELETE(self):
+            self._dispatch("DELETE")
+
+        def do_HEAD(self):
+            self._dispatch("HEAD")
+
+    return Handler
+
+
+# === Elasticsearch ===
+def _es_not_found(kind="resource_not_found_exception"):
+    return 404, {"error": {"type": kind, "reason": "not found"}, "status": 404}
+
+
+def es_ilm_get(s, q, b, name=None):
+    if name is None:
+        return 200, s.ilm
+    names = [n for n in s.ilm if fnmatch.fnmatch(n, name)] if "*" in name else [name]
+    if not all(n in s.ilm for n in names):
+        return _es_not_found()
+    return 200, {n: s.ilm[n] for n in names}
+
+
+def es_ilm_put(s, q, b, name):
+    s.ilm[name] = {"version": s.ilm.get(name, {}).get("version", 0) + 1, "policy": b["policy"]}
+    return 200, {"acknowledged": True}
+
+
+def es_template_get(s, q, b, name=None):
+    names = [n for n in s.templates if name is None or fnmatch.fnmatch(n, name)]
+    if name and "*" not in name and name not in s.templates:
+        return _es_not_found()
+    return 200, {"index_templates": [{"name": n, "index_template": s.templates[n]} for n in names]}
+
+
+def es_template_put(s, q, b, name):
+    s.templates[name] = b
+    return 200, {"acknowledged": True}
+
+
+def es_component_template_get(s, q, b, name):
+    names = [n for n in s.component_templates if fnmatch.fnmatch(n, name)]
+    if "*" not in name and name not in s.component_templates:
+        return _es_not_found()
+    return 200, {"component_templates": [{"name": n, "component_template": s.component_templates[n]} for n in names]}
+
+
+def es_component_template_put(s, q, b, name):
+    s.component_templates[name] = b
+    return 200, {"acknowledged": True}
+
+
+def es_cat_aliases(s, q, b, name="*"):
+    rows = []
+    for index, meta in s.indices.items():
+        for alias in meta["aliases"]:
+            if fnmatch.fnmatch(alias, name):
+                rows.append({"alias": alias, "index": index})
+    return 200, rows
+
+
+def es_cat_indices(s, q, b, name="*"):
+    return 200, [{"index": index, "pri.store.size": str(meta.get("size", 0)), "creation.date": str(meta["created"])}
+                 for index, meta in s.indices.items() if fnmatch.fnmatch(index, name)]
+
+
+def es_index_create(s, q, b, name):
+    if name in s.indices:
+        return 400, {"error": {"type": "resource_already_exists_exception", "reason": "exists"}, "status": 400}
+    s.indices[name] = {"aliases": (b or {}).get("aliases", {}), "created": int(time.time() * 1000)}
+    return 200, {"acknowledged": True, "index": name}
+
+
+def es_role_get(s, q, b, name=None):
+    if name is None:
+        return 200, s.roles
+    names = name.split(",")
+    found = {n: s.roles[n] for n in names if n in s.roles}
+    if not found:
+        return 404, {}
+    return 200, found
+
+
+def es_role_put(s, q, b, name):
+    created = name not in s.roles
+    role = dict(b)
+    role["indices"] = [dict(i, allow_restricted_indices=False) for i in role.get("indices", [])]
+    s.roles[name] = role
+    return 200, {"role": {"created": created}}
+
+
+def es_mapping_get(s, q, b, name=None):
+    if name is None:
+        return 200, s.role_mappings
+    if name not in s.role_mappings:
+        return 404, {}
+    return 200, {name: s.role_mappings[name]}
+
+
+def es_mapping_put(s, q, b, name):
+    created = name not in s.role_mappings
+    # Как ES: шаблон role_templates хранится и отдаётся строкой JSON
+    s.role_mappings[name] = dict(b, role_templates=[
+        dict(t, template=json.dumps(t["template"], separators=(",", ":")) if isinstance(t.get("template"), dict)
+             else t.get("template"))
+        for t in b["role_templates"]]) if "role_templates" in b else b
+    return 200, {"role_mapping": {"created": created}}
+
+
+def es_mapping_delete(s, q, b, name):
+    found = s.role_mappings.pop(name, None) is not None
+    return (200 if found else 404), {"found": found}
+
+
+def es_root(s, q, b):
+    return 200, {"version": {"number": "8.13.0"}, "tagline": "You Know, for Search"}
+
+
+# === Kibana ===
+
+
+def kb_bulk_get(s, q, b):
+    out = []
+    for ref in b:
+        key = (ref["type"], ref["id"])
+        if key in s.saved_objects:
+            out.append({"id": ref["id"], "type": ref["type"], "attributes": s.saved_objects[key]})
+        else:
+            out.append({"id": ref["id"], "type": ref["type"],
+                        "error": {"statusCode": 404, "error": "Not Found"}})
+    return 200, {"saved_objects": out}
+
+
+def kb_bulk_create(s, q, b):
+    out = []
+    for obj in b:
+        key = (obj["type"], obj["id"])
+        if key in s.saved_objects and q.get("overwrite") != "true":
+            out.append({"id": obj["id"], "type": obj["type"], "error": {"statusCode": 409, "error": "Conflict"}})
+        else:
+            s.saved_objects[key] = obj["attributes"]
+            out.append({"id": obj["id"], "type": obj["type"], "attributes": obj["attributes"]})
+    return 200, {"saved_objects": out}
+
+
+# === Keycloak ===
+def kc_token(s, q, b, realm):
+    return 200, {"access_token": uuid.uuid4().hex, "expires_in": 60,
+                 "refresh_token": uuid.uuid4().hex, "refresh_expires_in": 1800}
+
+
+def kc_realm_get(s, q, b, realm):
+    if realm not in s.realms:
+        return 404, {"error": "Realm not found."}
+    return 200, s.realms[realm]
+
+
+def kc_realms_list(s, q, b):
+    return 200, list(s.realms.values())
+
+
+def kc_realm_create(s, q, b):
+    s.realms[b["realm"]] = {"id": uuid.uuid4().hex, "realm": b["realm"], "enabled": True}
+    s.groups.setdefault(b["realm"], {})
+    s.kc_roles.setdefault(b["realm"], {})
+    return 201, None
+
+
+# Группы реалма: id -> {"id", "name", "path", "parent", "children": [id], "realmRoles": []},
+# плюс индекс path -> id, чтобы большие деревья (десятки тысяч групп) не сканировались целиком
+def _realm_groups(s, realm):
+    return s.groups.setdefault(realm, {}), s.group_paths.setdefault(realm, {})
+
+
+def _group_rep(g, brief):
+    rep = {"id": g["id"], "name": g["name"], "path": g["path"], "subGroupCount": len(g["children"]),
+           "subGroups": []}
+    if not brief:
+        rep["realmRoles"] = list(g["realmRoles"])
+    return rep
+
+
+def _group_tree(groups, g, brief):
+    rep = _group_rep(g, brief)
+    rep["subGroups"] = [_group_tree(groups, groups[c], brief)
+                        for c in sorted(g["children"], key=lambda c: groups[c]["name"])]
+    return rep
+
+
+def _page(items, q):
+    first = int(q.get("first", 0))
+    maximum = int(q.get("max", 100))
+    return items[first:first + maximum]
+
+
+def kc_groups_list(s, q, b, realm):
+    groups, _ = _realm_groups(s, realm)
+    brief = q.get("briefRepresentation", "true") != "false"
+    top = sorted((g for g in groups.values() if g["parent"] is None), key=lambda g: g["name"])
+    if q.get("search"):
+        top = [g for g in top if (q["search"] == g["name"] if q.get("exact") == "true" else q["search"] in g["name"])]
+        if s.search_subtree:
+            return 200, [_group_tree(groups, g, brief) for g in _page(top, q)]
+    return 200, [_group_rep(g, brief) for g in _page(top, q)]
+
+
+def kc_group_children(s, q, b, realm, gid):
+    groups, _ = _realm_groups(s, realm)
+    if gid not in groups:
+        return 404, {"error": "Could not find group by id"}
+    brief = q.get("briefRepresentation", "true") != "false"
+    children = sorted((groups[c] for c in groups[gid]["children"]), key=lambda g: g["name"])
+    return 200, [_group_rep(g, brief) for g in _page(children, q)]
+
+
+def kc_group_get(s, q, b, realm, gid):
+    groups, _ = _realm_groups(s, realm)
+    if gid not in groups:
+        return 404, {"error": "Could not find group by id"}
+    return 200, _group_rep(groups[gid], False)
+
+
+def kc_group_by_path(s, q, b, realm, path):
+    groups, paths = _realm_groups(s, realm)
+    gid = paths.get("/" + path.strip("/"))
+    if gid is None:
+        return 404, {"error": "Group path does not exist"}
+    return 200, _group_rep(groups[gid], False)
+
+
+def create_group(s, realm, parent, name):
+    groups, paths = _realm_groups(s, realm)
+    parent_path = groups[parent]["path"] if parent else ""
+    path = f"{parent_path}/{name}"
+    if path in paths:
+        return 409, {"errorMessage": "Top level group named already exists."}
+    gid = uuid.uuid4().hex
+    groups[gid] = {"id": gid, "name": name, "path": path, "parent": parent, "children": [], "realmRoles": []}
+    paths[path] = gid
+    if parent:
+        groups[parent]["children"].append(gid)
+    return 201, None, {"Location": f"http://kc/admin/realms/{realm}/groups/{gid}"}
+
+
+def kc_group_create(s, q, b, realm):
+    return create_group(s, realm, None, b["name"])
+
+
+def kc_child_create(s, q, b, realm, gid):
+    return create_group(s, realm, gid, b["name"])
+
+
+def kc_roles_list(s, q, b, realm):
+    roles = sorted(s.kc_roles.setdefault(realm, {}).values(), key=lambda r: r["name"])
+    return 200, _page(roles, q) if "first" in q or "max" in q else roles
+
+
+def kc_role_get(s, q, b, realm, name):
+    role = s.kc_roles.setdefault(realm, {}).get(name)
+    return (200, role) if role else (404, {"error": "Could not find role"})
+
+
+def kc_role_create(s, q, b, realm):
+    roles = s.kc_roles.setdefault(realm, {})
+    if b["name"] in roles:
+        return 409, {"errorMessage": "Role with name exists"}
+    roles[b["name"]] = {"id": uuid.uuid4().hex, "name": b["name"], "composite": False}
+    return 201, None, {"Location": f"http://kc/admin/realms/{realm}/roles/{b['name']}"}
+
+
+def kc_mappings_get(s, q, b, realm, gid):
+    g = s.groups.setdefault(realm, {}).get(gid)
+    if not g:
+        return 404, {}
+    roles = s.kc_roles.setdefault(realm, {})
+    return 200, [roles[n] for n in g["realmRoles"] if n in roles]
+
+
+def kc_mappings_post(s, q, b, realm, gid):
+    g = s.groups.setdefault(realm, {}).get(gid)
+    if not g:
+        return 404, {}
+    for r in b:
+        if r["name"] not in g["realmRoles"]:
+            g["realmRoles"].append(r["name"])
+    return 204, None
+
+
+# Как в Keycloak: роли пропускаются по имени, группы - по имени корневой группы целиком с поддеревом
+def _import_group(s, realm, parent, rep):
+    _, _, headers = create_group(s, realm, parent, rep["name"])
+    gid = headers["Location"].rsplit("/", 1)[1]
+    s.groups[realm][gid]["realmRoles"] = list(rep.get("realmRoles", []))
+    for child in rep.get("subGroups", []):
+        _import_group(s, realm, gid, child)
+    return gid
+
+
+def kc_partial_import(s, q, b, realm):
+    if b.get("ifResourceExists") != "SKIP":
+        return 400, {"errorMessage": "only SKIP is supported by the fake"}
+    roles = s.kc_roles.setdefault(realm, {})
+    _, paths = _realm_groups(s, realm)
+    results = []
+    for role in b.get("roles", {}).get("realm", []):
+        action = "SKIPPED" if role["name"] in roles else "ADDED"
+        if action == "ADDED":
+            roles[role["name"]] = {"id": uuid.uuid4().hex, "name": role["name"], "composite": False}
+        results.append({"action": action, "resourceType": "REALM_ROLE", "resourceName": role["name"],
+                        "id": roles[role["name"]]["id"]})
+    for group in b.get("groups", []):
+        if f"/{group['name']}" in paths:
+            results.append({"action": "SKIPPED", "resourceType": "GROUP", "resourceName": group["name"],
+                            "id": paths[f"/{group['name']}"]})
+        else:
+            results.append({"action": "ADDED", "resourceType": "GROUP", "resourceName": group["name"],
+                            "id": _import_group(s, realm, None, group)})
+    added = sum(1 for r in results if r["action"] == "ADDED")
+    return 200, {"overwritten": 0, "added": added, "skipped": len(results) - added, "results": results}
+
+
+# (API, (метод, путь-регулярка), обработчик). Обработчик возвращает (статус, тело[, заголовки])
+ROUTES = [
+    ("es", ("GET", r"/"), es_root),
+    ("es", ("GET", r"/_ilm/policy"), es_ilm_get),
+    ("es", ("GET", r"/_ilm/policy/([^/]+)"), es_ilm_get),
+    ("es", ("PUT", r"/_ilm/policy/([^/]+)"), es_ilm_put),
+    ("es", ("GET", r"/_index_template"), es_template_get),
+    ("es", ("GET", r"/_index_template/([^/]+)"), es_template_get),
+    ("es", ("PUT", r"/_index_template/([^/]+)"), es_template_put),
+    ("es", ("GET", r"/_component_template/([^/]+)"), es_component_template_get),
+    ("es", ("PUT", r"/_component_template/([^/]+)"), es_component_template_put),
+    ("es", ("GET", r"/_cat/aliases"), es_cat_aliases),
+    ("es", ("GET", r"/_cat/aliases/([^/]+)"), es_cat_aliases),
+    ("es", ("GET", r"/_cat/indices"), es_cat_indices),
+    ("es", ("GET", r"/_cat/indices/([^/]+)"), es_cat_indices),
+    ("es", ("GET", r"/_security/role"), es_role_get),
+    ("es", ("GET", r"/_security/role/([^/]+)"), es_role_get),
+    ("es", ("PUT", r"/_security/role/([^/]+)"), es_role_put),
+    ("es", ("POST", r"/_security/role/([^/]+)"), es_role_put),
+    ("es", ("GET", r"/_security/role_mapping"), es_mapping_get),
+    ("es", ("GET", r"/_security/role_mapping/([^/]+)"), es_mapping_get),
+    ("es", ("PUT", r"/_security/role_mapping/([^/]+)"), es_mapping_put),
+    ("es", ("POST", r"/_security/role_mapping/([^/]+)"), es_mapping_put),
+    ("es", ("DELETE", r"/_security/role_mapping/([^/]+)"), es_mapping_delete),
+    ("es", ("PUT", r"/([^/_][^/]*)"), es_index_create),
+    ("kibana", ("POST", r"/api/saved_objects/_bulk_get"), kb_bulk_get),
+    ("kibana", ("POST", r"/api/saved_objects/_bulk_create"), kb_bulk_create),
+    ("keycloak", ("POST", r"/realms/([^/]+)/protocol/openid-connect/token"), kc_token),
+    ("keycloak", ("GET", r"/admin/realms"), kc_realms_list),
+    ("keycloak", ("POST", r"/admin/realms"), kc_realm_create),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)"), kc_realm_get),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/groups"), kc_groups_list),
+    ("keycloak", ("POST", r"/admin/realms/([^/]+)/groups"), kc_group_create),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/groups/([^/]+)"), kc_group_get),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/groups/([^/]+)/children"), kc_group_children),
+    ("keycloak", ("POST", r"/admin/realms/([^/]+)/groups/([^/]+)/children"), kc_child_create),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/group-by-path/(.+)"), kc_group_by_path),
+    ("keycloak", ("POST", r"/admin/realms/([^/]+)/partialImport"), kc_partial_import),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/roles"), kc_roles_list),
+    ("keycloak", ("POST", r"/admin/realms/([^/]+)/roles"), kc_role_create),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/roles/([^/]+)"), kc_role_get),
+    ("keycloak", ("GET", r"/admin/realms/([^/]+)/groups/([^/]+)/role-mappings/realm"), kc_mappings_get),
+    ("keycloak", ("POST", r"/admin/realms/([^/]+)/groups/([^/]+)/role-mappings/realm"), kc_mappings_post),
+]
+
+
+# Запуск сервера в фоновом потоке, возвращает (сервер, базовый URL)
+def start(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
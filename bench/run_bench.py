@@ -0,0 +1,196 @@
+# Бенчмарк синхронизации ELK/Keycloak на локальных заглушках (bench/fake_servers.py).
+# Запускает единый процесс elk_kk_reconcile.py в нескольких сценариях подряд и для каждого
+# выводит время и число HTTP-запросов к ES, Kibana и Keycloak. Число запросов сравнивается
+# с бюджетом из bench/budgets.json: если стало больше, выход с кодом 1.
+#
+#   python3 bench/run_bench.py                          # профиль по умолчанию, проверка бюджета
+#   python3 bench/run_bench.py --tenants 1000 --noise-groups 10000 --latency-ms 5
+#   python3 bench/run_bench.py --index-mode data_stream # тенанты в режиме data stream
+#   python3 bench/run_bench.py --role-mapping-mode templated
+#   python3 bench/run_bench.py --provision-mode partial_import
+#   python3 bench/run_bench.py --group-search flat      # Keycloak без поддерева в поиске групп
+#   python3 bench/run_bench.py --update-budgets         # записать текущие значения как бюджет
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_servers
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RECONCILE_SCRIPT = os.path.join(REPO_DIR, "elk_kk_index_group_role", "elk_kk_reconcile.py")
+PYTHONPATH = [REPO_DIR, os.path.join(REPO_DIR, "elk_auto_index"), os.path.join(REPO_DIR, "elk_kk_index_group_role")]
+BUDGETS_FILE = os.path.join(BENCH_DIR, "budgets.json")
+
+REALM = "bench"
+FAMILIES = ["es", "kibana", "keycloak"]
+TEAMLEAD_ROLE = {"cluster": [], "indices": [], "applications": [], "run_as": [], "metadata": {}}
+
+
+# === Сценарии ===
+# Идут по порядку на одном наборе данных: (имя, описание, число тенантов, FULL_VERIFY_HOURS)
+def scenarios(tenants):
+    return [
+        ("cold", "пустые ES/Kibana/Keycloak", tenants, "24"),
+        ("noop_full", "повтор без изменений, полная сверка", tenants, "0"),
+        ("noop", "повтор без изменений, инкрементально", tenants, "24"),
+        ("add_tenant", "добавлен один common_name", tenants + 1, "24"),
+    ]
+
+
+def seed(state, noise_groups):
+    # Чужие группы в том же реалме: скрипты не должны их обходить
+    fake_servers.kc_realm_create(state, {}, {"realm": REALM})
+    if noise_groups:
+        _, _, headers = fake_servers.create_group(state, REALM, None, "other")
+        parent = headers["Location"].rsplit("/", 1)[1]
+        for i in range(noise_groups):
+            fake_servers.create_group(state, REALM, parent, f"team{i}")
+    state.roles["teamlead-viewer"] = dict(TEAMLEAD_ROLE)
+
+
+def run_reconcile(url, workdir, tenant_count, full_verify_hours, args, extra_env=None):
+    names = [f"t{i}" for i in range(tenant_count)]
+    common_name_file = os.path.join(workdir, "common_name")
+    with open(common_name_file, 'w') as file:
+        file.write(",".join(names))
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(PYTHONPATH),
+        "KEYCLOAK_URL": url, "MASTER_REALM": "master", "CLIENT_ID": "admin-cli", "CLIENT_SECRET": "secret",
+        "ADMIN_USER": "admin", "ADMIN_PASSWORD": "password",
+        "NEW_REALM": REALM, "REALM": REALM,
+        "GROUPS_TO_CREATE": "elk", "SUBGROUPS": " ".join(names), "ROLE_SUFFIX": "read, admin",
+        "TARGET_GROUP_PATH": "/elk",
+        "ES_HOST": url, "ES_URL": url, "KIBANA_HOST": url,
+        "USERNAME": "elastic", "ES_USER": "elastic", "ELK_PASSWORD": "password", "ES_PASSWORD": "password",
+        "COMMON_NAME_FILE": common_name_file,
+        "STATE_FILE": os.path.join(workdir, "state.json"),
+        "FULL_VERIFY_HOURS": full_verify_hours,
+        "INDEX_MODE": args.index_mode,
+        "ROLE_MAPPING_MODE": args.role_mapping_mode,
+        "PROVISION_MODE": args.provision_mode,
+        **(extra_env or {}),
+    })
+    started = time.monotonic()
+    result = subprocess.run([sys.executable, RECONCILE_SCRIPT], env=env, capture_output=True, text=True)
+    return result, time.monotonic() - started
+
+
+# Сбой записи шаблона индекса у нового тенанта: прогон должен завершиться с ошибкой
+# и выгрузить sync_run_success 0 (в бюджет не входит)
+def check_failure_reported(state, url, workdir, args):
+    state.fail_routes.add(("PUT", r"/_index_template/([^/]+)"))
+    try:
+        result, _ = run_reconcile(url, workdir, args.tenants + 2, "24", args,
+                                  {"METRICS_TEXTFILE_DIR": workdir})
+    finally:
+        state.fail_routes.clear()
+    try:
+        with open(os.path.join(workdir, "elk_kk_reconcile.prom"), 'r') as file:
+            metrics = file.read()
+    except FileNotFoundError:
+        metrics = ""
+    if result.returncode != 0 and 'sync_run_success{job="elk_kk_reconcile"} 0' in metrics:
+        print("failure      прогон со сбоем: exit code %d, sync_run_success 0" % result.returncode)
+        return True
+    print(f"[ERROR] failure: прогон со сбоем не отмечен как неуспешный (exit code {result.returncode})\n"
+          f"{result.stdout[-2000:]}")
+    return False
+
+
+def profile_key(args):
+    key = f"tenants={args.tenants},noise_groups={args.noise_groups}"
+    if args.index_mode != "index":
+        key += f",index_mode={args.index_mode}"
+    if args.role_mapping_mode != "per_group":
+        key += f",role_mapping_mode={args.role_mapping_mode}"
+    if args.provision_mode != "api":
+        key += f",provision_mode={args.provision_mode}"
+    if args.group_search != "subtree":
+        key += f",group_search={args.group_search}"
+    return key
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк синхронизации ELK/Keycloak на заглушках")
+    parser.add_argument("--tenants", type=int, default=20, help="число common_name")
+    parser.add_argument("--noise-groups", type=int, default=1000, help="чужих групп в реалме Keycloak")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка заглушек на каждый запрос")
+    parser.add_argument("--index-mode", choices=["index", "data_stream"], default="index",
+                        help="INDEX_MODE для elk_auto_index")
+    parser.add_argument("--role-mapping-mode", choices=["per_group", "templated"], default="per_group",
+                        help="ROLE_MAPPING_MODE для role_mapping и ролей тенантов")
+    parser.add_argument("--provision-mode", choices=["api", "partial_import"], default="api",
+                        help="PROVISION_MODE для групп и ролей Keycloak")
+    parser.add_argument("--group-search", choices=["subtree", "flat"], default="subtree",
+                        help="отдаёт ли поиск групп Keycloak поддерево (flat - только subGroupCount)")
+    parser.add_argument("--update-budgets", action="store_true", help="записать результат как бюджет профиля")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    state = fake_servers.FakeState(latency=args.latency_ms / 1000)
+    state.search_subtree = args.group_search == "subtree"
+    seed(state, args.noise_groups)
+    server, url = fake_servers.start(state)
+
+    results = {}
+    failed = False
+    print(f"{'scenario':<12} {'time_s':>8} {'total':>7} " + " ".join(f"{f:>9}" for f in FAMILIES))
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, description, tenant_count, full_verify_hours in scenarios(args.tenants):
+            state.reset_counts()
+            result, elapsed = run_reconcile(url, workdir, tenant_count, full_verify_hours, args)
+            counts = {family: state.total(family) for family in FAMILIES}
+            results[name] = counts
+            print(f"{name:<12} {elapsed:>8.2f} {sum(counts.values()):>7} "
+                  + " ".join(f"{counts[f]:>9}" for f in FAMILIES) + f"   # {description}")
+            if result.returncode != 0:
+                failed = True
+                print(f"[ERROR] {name}: exit code {result.returncode}\n{result.stdout[-2000:]}{result.stderr[-2000:]}")
+            if state.total("unknown"):
+                failed = True
+                unknown = [f"{m} {p}" for (f, m, p), v in state.requests.items() if f == "unknown"]
+                print(f"[ERROR] {name}: запросы без маршрута в заглушке: {', '.join(unknown)}")
+        failed = not check_failure_reported(state, url, workdir, args) or failed
+    server.shutdown()
+
+    try:
+        with open(BUDGETS_FILE, 'r') as file:
+            budgets = json.load(file)
+    except FileNotFoundError:
+        budgets = {}
+
+    key = profile_key(args)
+    if args.update_budgets:
+        budgets[key] = results
+        with open(BUDGETS_FILE, 'w') as file:
+            json.dump(budgets, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"\nБюджет для профиля '{key}' записан в {os.path.relpath(BUDGETS_FILE, REPO_DIR)}.")
+    elif key not in budgets:
+        print(f"\nДля профиля '{key}' бюджета нет, сравнение пропущено.")
+    else:
+        for name, counts in results.items():
+            for family, count in counts.items():
+                budget = budgets[key].get(name, {}).get(family)
+                if budget is not None and count > budget:
+                    failed = True
+                    print(f"[REGRESSION] {name}/{family}: {count} запросов, бюджет {budget}")
+        if not failed:
+            print("\nЧисло запросов в пределах бюджета.")
+
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,247 +1,706 @@
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import ConnectionError, AuthenticationException, TransportError, NotFoundError
-import urllib3
-import requests
-import json
-import os
-
-# Отключаем предупреждения об отключении проверки сертификатов
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-# Настройки подключения к ES / Kibana
-es_host = os.getenv('ES_HOST')
-kibana_host = os.getenv('KIBANA_HOST')
-username = os.getenv('USERNAME')
-password = os.getenv('ELK_PASSWORD')
-
-target_group_path = os.getenv('TARGET_GROUP_PATH').strip().strip('/')
-
-if not password:
-    print("Password not found in environment variables.")
-    exit(1)
-
-# Создаем клиент Elasticsearch
-es = Elasticsearch(
-    [es_host],
-    basic_auth=(username, password),
-    verify_certs=False
-)
-
-# Чтение common_name из ConfigMap
-try:
-    with open('/etc/config/common_name', 'r') as file:
-        common_names = file.read().strip()
-except Exception as e:
-    print(f"Failed to read common_name from ConfigMap: {e}")
-    common_names = ""
-
-if not common_names:
-    print('ConfigMap is empty, nothing to do.')
-else:
-    for name in common_names.split(','):
-        common_name = name.strip()
-        if not common_name:
-            continue
-
-        print(f"\n--- Processing common_name: {common_name} ---")
-
-        # === 1. ПРОВЕРКА И СОЗДАНИЕ ILM POLICY ===
-        try:
-            ilm_policy_name = f'{common_name}-policy'
-            try:
-                es.ilm.get_lifecycle(name=ilm_policy_name)
-                print(f"ILM policy '{ilm_policy_name}' exists.")
-            except NotFoundError:
-                print(f"ILM policy '{ilm_policy_name}' not found. Creating...")
-                lifecycle_policy = {
-                    "policy": {
-                        "phases": {
-                            "hot": {
-                                "min_age": "0ms",
-                                "actions": {
-                                    "rollover": {
-                                        "max_age": "1d",
-                                        "max_primary_shard_size": "1gb"
-                                    },
-                                    "set_priority": {
-                                        "priority": 100
-                                    }
-                                }
-                            },
-                            "delete": {
-                                "min_age": "30d",
-                                "actions": {
-                                    "delete": {
-                                        "delete_searchable_snapshot": True
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-                es.ilm.put_lifecycle(name=ilm_policy_name, body=lifecycle_policy)
-                print(f"ILM policy '{ilm_policy_name}' created.")
-        except Exception as e:
-            print(f"Error handling ILM policy: {e}")
-
-        # === 2. ПРОВЕРКА И СОЗДАНИЕ ШАБЛОНА ИНДЕКСА ===
-        try:
-            template_name = f"{common_name}-template"
-            if es.indices.exists_index_template(template_name):
-                print(f"Index template '{template_name}' already exists.")
-            else:
-                index_template = {
-                    "index_patterns": [f"{common_name}-*"],
-                    "template": {
-                        "settings": {
-                            "index": {
-                                "lifecycle": {
-                                    "name": ilm_policy_name,
-                                    "rollover_alias": f"{common_name}_logs"
-                                },
-                                "number_of_shards": 3,
-                                "number_of_replicas": 2,
-                                "codec": "best_compression"
-                            }
-                        },
-                    },
-                    "priority": 100
-                }
-                es.indices.put_index_template(name=template_name, body=index_template)
-                print(f"Index template '{template_name}' created.")
-        except Exception as e:
-            print(f"Error creating index template: {e}")
-
-        # === 3. СОЗДАНИЕ ПЕРВОГО ИНДЕКСА С АЛИАСОМ ===
-        try:
-            index_name = f"{common_name}-000001"
-            alias_name = f"{common_name}_logs"
-            if es.indices.exists(index=index_name):
-                print(f"Index '{index_name}' already exists.")
-            else:
-                index_body = {
-                    "aliases": {
-                        alias_name: {
-                            "is_write_index": True
-                        }
-                    }
-                }
-                es.indices.create(index=index_name, body=index_body)
-                print(f"Index '{index_name}' created with write alias.")
-        except Exception as e:
-            print(f"Error creating initial index: {e}")
-
-        # === 4. СОЗДАНИЕ DATA VIEW В KIBANA ===
-        try:
-            data_view_payload = {
-                "attributes": {
-                    "name": common_name,
-                    "title": f"{common_name}-*",
-                    "timeFieldName": "timestamp"
-                }
-            }
-            headers = {
-                "Content-Type": "application/json",
-                "kbn-xsrf": "true"
-            }
-            kibana_url = f"{kibana_host}/api/saved_objects/index-pattern/{common_name}"
-            kibana_response = requests.post(
-                kibana_url,
-                auth=(username, password),
-                headers=headers,
-                data=json.dumps(data_view_payload),
-                verify=False
-            )
-
-            if kibana_response.status_code in [200, 201]:
-                print(f"Data View '{common_name}' created in Kibana.")
-            else:
-                print(f"Failed to create Data View: {kibana_response.status_code}, {kibana_response.text}")
-        except Exception as e:
-            print(f"Error creating Data View: {e}")
-
-        # === 5. СОЗДАНИЕ РОЛЕЙ read и admin ===
-        ROLES_CONFIG = {
-            "read": {
-                "privileges": ["read"],
-                "kibana_features": [
-                    "feature_discover.read",
-                    "feature_visualize.read",
-                    "feature_dashboard.read"
-                ],
-                "kibana_spaces": ["space:default"]
-            },
-            "admin": {
-                "privileges": ["read", "write", "create_index", "delete_index", "manage", "index", "create", "delete"],
-                "kibana_features": [
-                    "feature_discover.all",
-                    "feature_visualize.all",
-                    "feature_dashboard.all",
-                    "feature_maps.all",
-                    "feature_canvas.all"
-                ],
-                "kibana_spaces": ["space:default"]
-            }
-        }
-
-        for role_type, config in ROLES_CONFIG.items():
-            try:
-                role_name = f"{target_group_path}{common_name}{role_type}"
-                role_payload = {
-                    "cluster": [],
-                    "indices": [
-                        {
-                            "names": [f"{common_name}-*"],
-                            "privileges": config["privileges"]
-                        }
-                    ],
-                    "applications": [
-                        {
-                            "application": "kibana-.kibana",
-                            "privileges": config["kibana_features"],
-                            "resources": ["space:default"]
-                        }
-                    ],
-                    "run_as": [],
-                    "metadata": {},
-                    "transient_metadata": {"enabled": True}
-                }
-
-                es.security.put_role(name=role_name, body=role_payload)
-                print(f"Role '{role_name}' created or updated.")
-            except Exception as e:
-                print(f"Failed to create/update role '{role_name}': {e}")
-
-        # === 6. ОБНОВЛЕНИЕ РОЛИ teamlead-viewer (только для read) ===
-        try:
-            role_name = "teamlead-viewer"
-            try:
-                role = es.security.get_role(name=role_name)
-                current_role = role.get(role_name, {})
-                indices = current_role.get("indices", [])
-                pattern = f"{common_name}-*"
-
-                # Проверяем, есть ли уже такой паттерн
-                if any(pattern in index.get("names", []) for index in indices):
-                    print(f"Role '{role_name}' already has access to '{pattern}'.")
-                else:
-                    indices.append({
-                        "names": [pattern],
-                        "privileges": ["read"]
-                    })
-
-                updated_payload = {
-                    "cluster": current_role.get("cluster", []),
-                    "indices": indices,
-                    "applications": current_role.get("applications", []),
-                    "run_as": current_role.get("run_as", []),
-                    "metadata": current_role.get("metadata", {}),
-                    "transient_metadata": current_role.get("transient_metadata", {"enabled": True})
-                }
-
-                es.security.put_role(name=role_name, body=updated_payload)
-                print(f"Role '{role_name}' updated with access to '{pattern}'.")
-            except NotFoundError:
-                print(f"Role '{role_name}' does not exist. Skipping update.")
-        except Exception as e:
-            print(f"Error updating role '{role_name}': {e}")
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError, BadRequestError
+from concurrent.futures import ThreadPoolExecutor
+from kibana_client import KibanaClient
+import sizing
+import tenants
+from run_state import RunState
+import run_metrics
+import random
+import time
+import urllib3
+import os
+
+# Отключаем предупреждения об отключении проверки сертификатов
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# Настройки подключения к ES / Kibana
+es_host = os.getenv('ES_HOST')
+kibana_host = os.getenv('KIBANA_HOST')
+username = os.getenv('USERNAME')
+password = os.getenv('ELK_PASSWORD')
+
+target_group_path = os.getenv('TARGET_GROUP_PATH', '').strip().strip('/')
+# Как называются роли тенанта (должно совпадать с ROLE_MAPPING_MODE в elk_keycloak_rolemappings.py):
+#   per_group - {группа}{common_name}{тип}, на каждую роль свой role_mapping
+#   templated - полный путь группы Keycloak, роли выдаёт шаблонный role_mapping по claim groups
+ROLE_MAPPING_MODE = os.getenv('ROLE_MAPPING_MODE', 'per_group')
+
+COMMON_NAME_FILE = os.getenv('COMMON_NAME_FILE', '/etc/config/common_name')
+# Спецификации тенантов (JSONL/YAML, см. tenants.py). Если файла нет - читается COMMON_NAME_FILE
+TENANTS_FILE = os.getenv('TENANTS_FILE', '/etc/config/tenants.jsonl')
+# Подбирать шарды/rollover по фактическому объёму тенанта (иначе - подсказка из ConfigMap или класс по умолчанию)
+AUTO_SIZING = os.getenv('AUTO_SIZING', 'true').lower() == 'true'
+# Режим для новых common_name:
+#   index       - своя ILM policy, полный шаблон и индекс {common_name}-000001 с write-алиасом
+#   data_stream - data stream {common_name}-logs: тонкий шаблон из общих component templates,
+#                 одна ILM policy на класс объёма, без bootstrap-индекса
+# Уже настроенные common_name остаются в своём режиме (определяется по их шаблону)
+INDEX_MODE = os.getenv('INDEX_MODE', 'index')
+# Префикс общих ILM policy и component templates режима data_stream
+SHARED_PREFIX = "elk-auto-index"
+TEAMLEAD_ROLE = "teamlead-viewer"
+# Сколько common_name обрабатывается параллельно
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', '8'))
+
+# Служебное поле в metadata teamlead-viewer: ревизия для оптимистичной блокировки
+TEAMLEAD_REVISION_KEY = "auto_index_revision"
+TEAMLEAD_MAX_ATTEMPTS = 5
+
+ROLES_CONFIG = {
+    "read": {
+        "privileges": ["read"],
+        "kibana_features": [
+            "feature_discover.read",
+            "feature_visualize.read",
+            "feature_dashboard.read"
+        ],
+        "kibana_spaces": ["space:default"]
+    },
+    "admin": {
+        "privileges": ["read", "write", "create_index", "delete_index", "manage", "index", "create", "delete"],
+        "kibana_features": [
+            "feature_discover.all",
+            "feature_visualize.all",
+            "feature_dashboard.all",
+            "feature_maps.all",
+            "feature_canvas.all"
+        ],
+        "kibana_spaces": ["space:default"]
+    }
+}
+
+
+# === Желаемое состояние тенанта ===
+def ilm_policy_name(common_name):
+    return f'{common_name}-policy'
+
+
+def alias_name(common_name):
+    return f"{common_name}_logs"
+
+
+def index_pattern(common_name):
+    return f"{common_name}-*"
+
+
+# Имя совпадает с sizing.DATA_STREAM_INDEX (по нему считается объём тенанта)
+def data_stream_name(common_name):
+    return f"{common_name}-logs"
+
+
+# Класс хранения в режиме data_stream: общие ILM policy и component template на класс объёма и срок хранения
+def retention_class(size, retention):
+    if retention == tenants.DEFAULT_RETENTION:
+        return size["class"]
+    return f"{size['class']}-{retention}"
+
+
+def shared_ilm_policy_name(size, retention):
+    return f"{SHARED_PREFIX}-{retention_class(size, retention)}-policy"
+
+
+# Режим тенанта: по его текущему шаблону, для нового - INDEX_MODE
+def tenant_mode(common_name, templates):
+    current = templates.get(f"{common_name}-template")
+    if current is None:
+        return INDEX_MODE
+    return "data_stream" if "data_stream" in current else "index"
+
+
+# size - параметры класса объёма тенанта (sizing.volume_class), retention - когда удалять индекс
+def desired_ilm_policy(size, retention):
+    return {
+        "phases": {
+            "hot": {
+                "min_age": "0ms",
+                "actions": {
+                    "rollover": {
+                        "max_age": size["max_age"],
+                        "max_primary_shard_size": size["max_primary_shard_size"]
+                    },
+                    "set_priority": {
+                        "priority": 100
+                    }
+                }
+            },
+            "delete": {
+                "min_age": retention,
+                "actions": {
+                    "delete": {
+                        "delete_searchable_snapshot": True
+                    }
+                }
+            }
+        }
+    }
+
+
+def desired_index_template(common_name, size):
+    return {
+        "index_patterns": [index_pattern(common_name)],
+        "template": {
+            "settings": {
+                "index": {
+                    "lifecycle": {
+                        "name": ilm_policy_name(common_name),
+                        "rollover_alias": alias_name(common_name)
+                    },
+                    "number_of_shards": size["shards"],
+                    "number_of_replicas": size["replicas"],
+                    "codec": "best_compression"
+                }
+            },
+        },
+        "priority": 100,
+        "_meta": {"volume_class": size["class"]}
+    }
+
+
+# === Режим data_stream: общие component templates и тонкий шаблон тенанта ===
+def desired_component_templates(size, retention):
+    return {
+        f"{SHARED_PREFIX}-mappings": {
+            "template": {
+                "mappings": {
+                    "properties": {
+                        "@timestamp": {"type": "date"}
+                    }
+                }
+            }
+        },
+        f"{SHARED_PREFIX}-settings-{size['class']}": {
+            "template": {
+                "settings": {
+                    "index": {
+                        "number_of_shards": size["shards"],
+                        "number_of_replicas": size["replicas"],
+                        "codec": "best_compression"
+                    }
+                }
+            }
+        },
+        f"{SHARED_PREFIX}-ilm-{retention_class(size, retention)}": {
+            "template": {
+                "settings": {
+                    "index": {
+                        "lifecycle": {
+                            "name": shared_ilm_policy_name(size, retention)
+                        }
+                    }
+                }
+            }
+        },
+    }
+
+
+def desired_data_stream_template(common_name, size, retention):
+    return {
+        "index_patterns": [data_stream_name(common_name)],
+        "data_stream": {},
+        "composed_of": list(desired_component_templates(size, retention)),
+        "priority": 100,
+        "_meta": {"volume_class": size["class"]}
+    }
+
+
+def role_name(common_name, role_type):
+    name = f"{target_group_path}{common_name}{role_type}"
+    if ROLE_MAPPING_MODE == "templated":
+        # Группа роли в Keycloak: /{группа}/{common_name}/{группа}{common_name}{тип} (keycloak_groups_roles.py)
+        return f"/{target_group_path}/{common_name}/{name}"
+    return name
+
+
+# overrides - замена privileges / kibana_features / kibana_spaces по типам ролей из спецификации тенанта
+def desired_roles(common_name, overrides=None):
+    roles = {}
+    for role_type, config in ROLES_CONFIG.items():
+        config = {**config, **(overrides or {}).get(role_type, {})}
+        roles[role_name(common_name, role_type)] = {
+            "cluster": [],
+            "indices": [
+                {
+                    "names": [index_pattern(common_name)],
+                    "privileges": config["privileges"]
+                }
+            ],
+            "applications": [
+                {
+                    "application": "kibana-.kibana",
+                    "privileges": config["kibana_features"],
+                    "resources": config["kibana_spaces"]
+                }
+            ],
+            "run_as": [],
+            "metadata": {},
+            "transient_metadata": {"enabled": True}
+        }
+    return roles
+
+
+def desired_data_view(common_name, mode):
+    return {
+        "name": common_name,
+        "title": index_pattern(common_name),
+        # Data stream требует поле @timestamp
+        "timeFieldName": "@timestamp" if mode == "data_stream" else "timestamp"
+    }
+
+
+# Всё, что скрипт применяет для тенанта; отпечаток этого состояния хранится между прогонами.
+# tenant - описание из tenants.read_tenants с выбранными в прогоне "size" и "mode"
+def tenant_spec(tenant):
+    common_name, size, retention = tenant["name"], tenant["size"], tenant["retention"]
+    if tenant["mode"] == "data_stream":
+        spec = {
+            "ilm": desired_ilm_policy(size, retention),
+            "component_templates": desired_component_templates(size, retention),
+            "template": desired_data_stream_template(common_name, size, retention),
+        }
+    else:
+        spec = {
+            "ilm": desired_ilm_policy(size, retention),
+            "template": desired_index_template(common_name, size),
+        }
+    spec.update({
+        "roles": desired_roles(common_name, tenant["roles"]),
+        "data_view": desired_data_view(common_name, tenant["mode"]),
+        "teamlead_pattern": index_pattern(common_name),
+    })
+    return spec
+
+
+def _scalar(value):
+    # ES отдает настройки строками ("3", "true"), поэтому сравниваем в строковом виде
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def is_subset(desired, actual):
+    """Проверяет, что всё описанное в desired уже есть в actual (лишние поля в actual допустимы)."""
+    if isinstance(desired, dict):
+        return isinstance(actual, dict) and all(
+            key in actual and is_subset(value, actual[key]) for key, value in desired.items()
+        )
+    if isinstance(desired, list):
+        return isinstance(actual, list) and len(desired) == len(actual) and all(
+            is_subset(d, a) for d, a in zip(desired, actual)
+        )
+    return actual is not None and _scalar(desired) == _scalar(actual)
+
+
+# === Снимок текущего состояния ES / Kibana (несколько bulk-запросов на весь прогон) ===
+def get_templates(es):
+    try:
+        templates = es.indices.get_index_template(name="*-template")["index_templates"]
+    except NotFoundError:
+        templates = []
+    return {t["name"]: t["index_template"] for t in templates}
+
+
+def get_component_templates(es):
+    try:
+        templates = es.cluster.get_component_template(name=f"{SHARED_PREFIX}-*")["component_templates"]
+    except NotFoundError:
+        templates = []
+    return {t["name"]: t["component_template"] for t in templates}
+
+
+# templates уже прочитаны в этом прогоне (по ним выбраны режим и класс объёма тенантов),
+# component templates нужны только если есть тенанты в режиме data_stream
+def take_snapshot(es, kibana, common_names, templates, with_components=False):
+    return {
+        "ilm": dict(es.ilm.get_lifecycle()),
+        "templates": templates,
+        "component_templates": get_component_templates(es) if with_components else {},
+        "aliases": {a["alias"] for a in es.cat.aliases(name="*_logs", format="json", h="alias")},
+        "roles": dict(es.security.get_role()),
+        # Data view с id = common_name, проверяем только нужные одним _bulk_get
+        "data_views": kibana.existing_ids("index-pattern", common_names),
+    }
+
+
+# === Общие объекты режима data_stream: ILM policy и component templates нужных классов хранения ===
+# Пишутся один раз за прогон до шаблонов тенантов, которые на них ссылаются.
+def reconcile_shared(es, snapshot, data_stream_tenants):
+    changes = []
+    errors = []
+    classes = {retention_class(t["size"], t["retention"]): (t["size"], t["retention"]) for t in data_stream_tenants}
+
+    for size, retention in classes.values():
+        policy_name = shared_ilm_policy_name(size, retention)
+        policy = desired_ilm_policy(size, retention)
+        current = snapshot["ilm"].get(policy_name)
+        try:
+            if current is None or not is_subset(policy, current.get("policy")):
+                es.ilm.put_lifecycle(name=policy_name, body={"policy": policy})
+                snapshot["ilm"][policy_name] = {"policy": policy}
+                changes.append(f"ILM policy '{policy_name}' {'created' if current is None else 'updated'}")
+        except Exception as e:
+            errors.append(f"Error handling ILM policy '{policy_name}': {e}")
+
+    components = {}
+    for size, retention in classes.values():
+        components.update(desired_component_templates(size, retention))
+    for name, body in components.items():
+        current = snapshot["component_templates"].get(name)
+        try:
+            if current is None or not is_subset(body, current):
+                es.cluster.put_component_template(name=name, body=body)
+                snapshot["component_templates"][name] = body
+                changes.append(f"Component template '{name}' {'created' if current is None else 'updated'}")
+        except Exception as e:
+            errors.append(f"Error handling component template '{name}': {e}")
+
+    return {"changes": changes, "errors": errors}
+
+
+# === Сверка тенанта со снимком и запись только недостающего / изменившегося ===
+# Шаги внутри одного тенанта идут строго по порядку, разные тенанты обрабатываются параллельно.
+# Data view создаются отдельно, одним _bulk_create на все тенанты (create_data_views).
+def reconcile_tenant(es, tenant, snapshot):
+    if tenant["mode"] == "data_stream":
+        return reconcile_data_stream_tenant(es, tenant, snapshot)
+
+    common_name, size = tenant["name"], tenant["size"]
+    changes = []
+    errors = []
+
+    # === 1. ILM POLICY ===
+    policy_name = ilm_policy_name(common_name)
+    try:
+        policy = desired_ilm_policy(size, tenant["retention"])
+        current = snapshot["ilm"].get(policy_name)
+        if current is None or not is_subset(policy, current.get("policy")):
+            es.ilm.put_lifecycle(name=policy_name, body={"policy": policy})
+            snapshot["ilm"][policy_name] = {"policy": policy}
+            changes.append(f"ILM policy '{policy_name}' {'created' if current is None else 'updated'}")
+    except Exception as e:
+        errors.append(f"Error handling ILM policy: {e}")
+
+    # === 2. ШАБЛОН ИНДЕКСА ===
+    template_name = f"{common_name}-template"
+    try:
+        template = desired_index_template(common_name, size)
+        current = snapshot["templates"].get(template_name)
+        if current is None or not is_subset(template, current):
+            es.indices.put_index_template(name=template_name, body=template)
+            snapshot["templates"][template_name] = template
+            changes.append(f"Index template '{template_name}' {'created' if current is None else 'updated'}")
+    except Exception as e:
+        errors.append(f"Error creating index template: {e}")
+
+    # === 3. ПЕРВЫЙ ИНДЕКС С АЛИАСОМ (только если write-алиаса еще нет) ===
+    alias = alias_name(common_name)
+    index_name = f"{common_name}-000001"
+    try:
+        if alias not in snapshot["aliases"]:
+            es.indices.create(index=index_name, body={"aliases": {alias: {"is_write_index": True}}})
+            snapshot["aliases"].add(alias)
+            changes.append(f"Index '{index_name}' created with write alias")
+    except BadRequestError as e:
+        if e.error == "resource_already_exists_exception":
+            errors.append(f"Index '{index_name}' already exists without alias '{alias}'")
+        else:
+            errors.append(f"Error creating initial index: {e}")
+    except Exception as e:
+        errors.append(f"Error creating initial index: {e}")
+
+    # === 5. РОЛИ read и admin ===
+    reconcile_roles(es, tenant, snapshot, changes, errors)
+
+    return {"common_name": common_name, "changes": changes, "errors": errors}
+
+
+# Режим data_stream: только тонкий шаблон и роли. ILM и component templates общие (reconcile_shared),
+# data stream создаётся самим ES при первой записи в {common_name}-logs
+def reconcile_data_stream_tenant(es, tenant, snapshot):
+    common_name = tenant["name"]
+    changes = []
+    errors = []
+
+    template_name = f"{common_name}-template"
+    try:
+        template = desired_data_stream_template(common_name, tenant["size"], tenant["retention"])
+        current = snapshot["templates"].get(template_name)
+        if current is None or not is_subset(template, current):
+            es.indices.put_index_template(name=template_name, body=template)
+            snapshot["templates"][template_name] = template
+            changes.append(f"Data stream template '{template_name}' {'created' if current is None else 'updated'}")
+    except Exception as e:
+        errors.append(f"Error creating index template: {e}")
+
+    reconcile_roles(es, tenant, snapshot, changes, errors)
+
+    return {"common_name": common_name, "changes": changes, "errors": errors}
+
+
+def reconcile_roles(es, tenant, snapshot, changes, errors):
+    for role_name, role_payload in desired_roles(tenant["name"], tenant["roles"]).items():
+        try:
+            current = snapshot["roles"].get(role_name)
+            if current is None or not is_subset(role_payload, current):
+                es.security.put_role(name=role_name, body=role_payload)
+                snapshot["roles"][role_name] = role_payload
+                changes.append(f"Role '{role_name}' {'created' if current is None else 'updated'}")
+        except Exception as e:
+            errors.append(f"Failed to create/update role '{role_name}': {e}")
+
+
+# === 4. DATA VIEW В KIBANA (один _bulk_create на все недостающие) ===
+def create_data_views(kibana, common_names, snapshot, results, modes):
+    missing = {name: desired_data_view(name, modes[name]) for name in common_names
+               if name not in snapshot["data_views"]}
+    if not missing:
+        return
+    try:
+        created, existing, errors = kibana.bulk_create("index-pattern", missing)
+    except Exception as e:
+        created, existing, errors = [], [], {name: str(e) for name in missing}
+    snapshot["data_views"].update(created, existing)
+    for name in created:
+        results[name]["changes"].append(f"Data View '{name}' created in Kibana")
+    for name, error in errors.items():
+        results[name]["errors"].append(f"Failed to create Data View: {error}")
+
+
+# === 6. ОБНОВЛЕНИЕ РОЛИ teamlead-viewer (только для read) ===
+# Одна запись на весь прогон: собираем паттерны всех common_name и добавляем недостающие разом.
+# Паттерны проверяются каждый прогон (один GET), а не по отпечаткам тенантов: роль общая для всех шардов
+# и могла потерять паттерны из-за чужой записи.
+# У ролей ES нет seq_no, поэтому оптимистичная блокировка - через ревизию в metadata:
+# сливаем с прочитанной ревизией, перед записью перечитываем роль и, если ревизия сменилась, сливаем заново.
+def merge_read_patterns(indices, patterns):
+    indices = [dict(index) for index in indices]
+    target = next((index for index in indices
+                   if index.get("privileges") == ["read"] and "query" not in index and "field_security" not in index),
+                  None)
+    if target is None:
+        target = {"names": [], "privileges": ["read"]}
+        indices.append(target)
+    target["names"] = list(target.get("names", [])) + list(patterns)
+    return indices
+
+
+def missing_patterns(role, patterns):
+    present = {name for index in role.get("indices", []) for name in index.get("names", [])}
+    return [pattern for pattern in patterns if pattern not in present]
+
+
+def get_teamlead_role(es):
+    try:
+        return es.security.get_role(name=TEAMLEAD_ROLE).get(TEAMLEAD_ROLE)
+    except NotFoundError:
+        return None
+
+
+def role_revision(role):
+    return int((role or {}).get("metadata", {}).get(TEAMLEAD_REVISION_KEY, 0))
+
+
+def update_teamlead_role(es, common_names):
+    patterns = [index_pattern(name) for name in common_names]
+    try:
+        current_role = get_teamlead_role(es)
+    except Exception as e:
+        print(f"Error reading role '{TEAMLEAD_ROLE}': {e}")
+        return False
+
+    for attempt in range(1, TEAMLEAD_MAX_ATTEMPTS + 1):
+        if current_role is None:
+            print(f"Role '{TEAMLEAD_ROLE}' does not exist. Skipping update.")
+            return True
+        missing = missing_patterns(current_role, patterns)
+        if not missing:
+            return True
+
+        base_revision = role_revision(current_role)
+        metadata = dict(current_role.get("metadata", {}))
+        metadata[TEAMLEAD_REVISION_KEY] = base_revision + 1
+        updated_payload = {
+            "cluster": current_role.get("cluster", []),
+            "indices": merge_read_patterns(current_role.get("indices", []), missing),
+            "applications": current_role.get("applications", []),
+            "run_as": current_role.get("run_as", []),
+            "metadata": metadata,
+            "transient_metadata": current_role.get("transient_metadata", {"enabled": True})
+        }
+        try:
+            # Сравнение ревизий непосредственно перед записью: если роль успели изменить,
+            # наше слияние построено на устаревшей версии и затёрло бы чужие паттерны
+            latest_role = get_teamlead_role(es)
+            if latest_role is None or role_revision(latest_role) != base_revision:
+                print(f"Role '{TEAMLEAD_ROLE}' was changed concurrently (revision {role_revision(latest_role)}, "
+                      f"merged from {base_revision}), merging again.")
+                current_role = latest_role
+                time.sleep(random.uniform(0.1, 0.5) * attempt)
+                continue
+            es.security.put_role(name=TEAMLEAD_ROLE, body=updated_payload)
+            current_role = get_teamlead_role(es)
+        except Exception as e:
+            print(f"Error updating role '{TEAMLEAD_ROLE}': {e}")
+            return False
+
+        # Окно между сравнением и записью остаётся, поэтому результат проверяется перечитыванием
+        if current_role is not None and not missing_patterns(current_role, patterns):
+            print(f"Role '{TEAMLEAD_ROLE}' updated with access to {len(missing)} new pattern(s).")
+            return True
+        print(f"Role '{TEAMLEAD_ROLE}' lost our patterns to a concurrent write "
+              f"(revision {role_revision(current_role)}), merging again.")
+        time.sleep(random.uniform(0.1, 0.5) * attempt)
+
+    print(f"Error updating role '{TEAMLEAD_ROLE}': gave up after {TEAMLEAD_MAX_ATTEMPTS} attempts.")
+    return False
+
+
+# Тенанты своего шарда из TENANTS_FILE или COMMON_NAME_FILE (tenants.py)
+def read_tenants():
+    return list(tenants.read_tenants(TENANTS_FILE, COMMON_NAME_FILE, ROLES_CONFIG))
+
+
+# Класс объёма каждого тенанта: подсказка, иначе измеренный объём (с учётом текущего класса из _meta шаблона)
+def choose_sizes(es, tenant_list, templates):
+    hints = {tenant["name"]: tenant["volume"] for tenant in tenant_list if tenant["volume"]}
+    try:
+        rates = sizing.measure_ingest(es)
+    except Exception as e:
+        print(f"Failed to measure ingest, keeping current volume classes: {e}")
+        rates = {}
+
+    sizes = {}
+    for tenant in tenant_list:
+        name = tenant["name"]
+        current = templates.get(f"{name}-template", {}).get("_meta", {}).get("volume_class")
+        chosen = sizing.choose_class(name, hints, rates, current)
+        if current and chosen != current:
+            measured = f" ({rates[name]:.1f} GB/day)" if name in rates else ""
+            print(f"Volume class of '{name}': {current} -> {chosen}{measured}.")
+        sizes[name] = sizing.volume_class(chosen)
+    return sizes
+
+
+# Клиент Elasticsearch (пул соединений рассчитан на MAX_WORKERS потоков).
+# Единый процесс (elk_kk_reconcile.py) создаёт его один раз и передаёт во все стадии, работающие с ES
+def make_es_client():
+    if not password:
+        print("Password not found in environment variables.")
+        exit(1)
+    es = Elasticsearch(
+        [es_host],
+        basic_auth=(username, password),
+        verify_certs=False,
+        connections_per_node=MAX_WORKERS
+    )
+    return run_metrics.instrument_es(es)
+
+
+def main(es=None):
+    if not password:
+        print("Password not found in environment variables.")
+        exit(1)
+
+    tenant_list = read_tenants()
+    if not tenant_list:
+        print('No tenants in this shard, nothing to do.' if tenants.SHARD_COUNT > 1
+              else 'No tenants configured, nothing to do.')
+        return
+    if tenants.SHARD_COUNT > 1:
+        print(f"Shard {tenants.SHARD_INDEX} of {tenants.SHARD_COUNT}: {len(tenant_list)} tenant(s).")
+
+    es = es or make_es_client()
+
+    # По текущим шаблонам определяются режим и класс объёма тенантов, дальше они же идут в снимок
+    try:
+        templates = get_templates(es)
+    except Exception as e:
+        print(f"Failed to read current index templates: {e}")
+        exit(1)
+
+    # Класс объёма входит в желаемое состояние: при его смене тенант сверяется заново
+    if AUTO_SIZING:
+        sizes = choose_sizes(es, tenant_list, templates)
+    else:
+        sizes = {tenant["name"]: sizing.volume_class(tenant["volume"] or sizing.DEFAULT_VOLUME_CLASS)
+                 for tenant in tenant_list}
+    for tenant in tenant_list:
+        tenant.update(size=sizes[tenant["name"]], mode=tenant_mode(tenant["name"], templates))
+    by_name = {tenant["name"]: tenant for tenant in tenant_list}
+    common_names = list(by_name)
+
+    # Инкрементальный режим: сверяем только тенанты, чьё желаемое состояние изменилось
+    # с прошлого успешного прогона (раз в FULL_VERIFY_HOURS - все). У каждого шарда своё состояние
+    state = RunState("elk_auto_index" if tenants.SHARD_COUNT <= 1
+                     else f"elk_auto_index-{tenants.SHARD_INDEX}-of-{tenants.SHARD_COUNT}")
+    full_verify = state.full_verify_due()
+    specs = {name: tenant_spec(tenant) for name, tenant in by_name.items()}
+    for name in state.removed(specs):
+        state.forget(name)
+    all_names, common_names = common_names, state.changed(specs)
+    if not common_names:
+        print(f"Nothing changed since the last run ({len(all_names)} common_name(s)), skipping.")
+        teamlead_ok = update_teamlead_role(es, all_names)
+        state.save()
+        if not teamlead_ok:
+            exit(1)
+        return
+    if not full_verify:
+        print(f"Incremental run: {len(common_names)} of {len(all_names)} common_name(s) changed.")
+
+    kibana = KibanaClient(kibana_host, username, password, pool_size=MAX_WORKERS)
+
+    data_stream_tenants = [by_name[name] for name in common_names if by_name[name]["mode"] == "data_stream"]
+    try:
+        snapshot = take_snapshot(es, kibana, common_names, templates, with_components=bool(data_stream_tenants))
+    except Exception as e:
+        print(f"Failed to read current ES/Kibana state: {e}")
+        exit(1)
+
+    shared = reconcile_shared(es, snapshot, data_stream_tenants)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        results = list(pool.map(lambda name: reconcile_tenant(es, by_name[name], snapshot), common_names))
+
+    modes = {name: tenant["mode"] for name, tenant in by_name.items()}
+    create_data_views(kibana, common_names, snapshot, {result["common_name"]: result for result in results}, modes)
+    teamlead_ok = update_teamlead_role(es, all_names)
+
+    # Запоминаем применённое состояние только для тенантов без ошибок
+    # (для data_stream - и без ошибок в общих ILM policy / component templates)
+    for result in results:
+        shared_ok = modes[result["common_name"]] != "data_stream" or not shared["errors"]
+        if shared_ok and not result["errors"]:
+            state.mark_applied(result["common_name"], specs[result["common_name"]])
+    state.save(full_verify=full_verify and teamlead_ok and not shared["errors"]
+               and not any(result["errors"] for result in results))
+
+    # === Итоговая сводка по всем тенантам ===
+    if shared["changes"] or shared["errors"]:
+        print("\n--- shared data stream objects ---")
+        for line in shared["changes"] + shared["errors"]:
+            print(f"{line}.")
+
+    changed = failed = up_to_date = 0
+    for result in results:
+        if not result["changes"] and not result["errors"]:
+            up_to_date += 1
+            continue
+        changed += bool(result["changes"])
+        failed += bool(result["errors"])
+        print(f"\n--- common_name: {result['common_name']} ---")
+        for change in result["changes"]:
+            print(f"{change}.")
+        for error in result["errors"]:
+            print(f"{error}.")
+
+    print(f"\nDone: {len(common_names)} common_name(s), {changed} changed, {failed} failed, "
+          f"{up_to_date} up to date.")
+    # Частичный сбой - неуспешный прогон (метрика sync_run_success и статус Job), как в стадиях Keycloak
+    if failed or shared["errors"] or not teamlead_ok:
+        exit(1)
+
+
+if __name__ == "__main__":
+    with run_metrics.run("elk_auto_index"):
+        main()
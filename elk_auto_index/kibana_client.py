@@ -0,0 +1,57 @@
+from requests.adapters import HTTPAdapter
+import requests
+
+import run_metrics
+
+# Клиент Kibana saved objects API поверх одной keep-alive сессии
+
+KIBANA_HEADERS = {
+    "Content-Type": "application/json",
+    "kbn-xsrf": "true"
+}
+
+
+class KibanaClient:
+    def __init__(self, host, username, password, pool_size=10):
+        self.host = host.rstrip('/')
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.session.verify = False
+        self.session.headers.update(KIBANA_HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        run_metrics.instrument_session(self.session, "kibana")
+
+    def _post(self, path, payload, **params):
+        response = self.session.post(f"{self.host}{path}", json=payload, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def existing_ids(self, object_type, ids):
+        """Одним _bulk_get возвращает множество id, которые уже есть в Kibana."""
+        if not ids:
+            return set()
+        result = self._post("/api/saved_objects/_bulk_get", [{"type": object_type, "id": i} for i in ids])
+        return {obj["id"] for obj in result.get("saved_objects", []) if "error" not in obj}
+
+    def bulk_create(self, object_type, objects):
+        """
+        Создает объекты одним _bulk_create (без overwrite).
+        objects: {id: attributes}. Возвращает (created, existing, errors), где errors = {id: текст ошибки};
+        409 считается не ошибкой, а уже существующим объектом.
+        """
+        created, existing, errors = [], [], {}
+        if not objects:
+            return created, existing, errors
+        payload = [{"type": object_type, "id": i, "attributes": attrs} for i, attrs in objects.items()]
+        result = self._post("/api/saved_objects/_bulk_create", payload)
+        for obj in result.get("saved_objects", []):
+            error = obj.get("error")
+            if not error:
+                created.append(obj["id"])
+            elif error.get("statusCode") == 409:
+                existing.append(obj["id"])
+            else:
+                errors[obj["id"]] = f"{error.get('statusCode')}, {error.get('message') or error.get('error')}"
+        return created, existing, errors
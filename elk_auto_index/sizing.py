@@ -0,0 +1,97 @@
+import os
+import re
+import time
+
+# Размер шардов, реплики и rollover для тенанта по объёму его логов.
+# Объём берётся из подсказки в ConfigMap (common_name: "test1:xs, test2:40gb") или измеряется
+# по индексам тенанта за последние дни (_cat/indices, один запрос на все тенанты).
+# Настройки шаблона и ILM меняются при смене класса и применяются к индексам после следующего rollover.
+
+# Классы объёма: (имя, до скольких ГБ primary в сутки, шардов, реплик, rollover max_age, max_primary_shard_size)
+VOLUME_CLASSES = [
+    ("xs", 1, 1, 1, "7d", "10gb"),
+    ("s", 10, 1, 1, "1d", "30gb"),
+    ("m", 60, 2, 2, "1d", "30gb"),
+    ("l", 200, 4, 2, "1d", "50gb"),
+    ("xl", None, 6, 2, "1d", "50gb"),
+]
+# Класс для тенанта без подсказки и без данных (новый тенант)
+DEFAULT_VOLUME_CLASS = os.getenv("DEFAULT_VOLUME_CLASS", "s")
+# За сколько дней смотрим на созданные индексы
+LOOKBACK_DAYS = 7
+# Объём тенанта, у которого индексы появились меньше суток назад, не измеряем (пустой bootstrap-индекс)
+MIN_OBSERVED_HOURS = 24
+# Понижаем класс, только если объём меньше этой доли от границы нового класса (без скачков туда-обратно)
+DOWNGRADE_RATIO = 0.5
+
+GB = 1024 ** 3
+INDEX_NAME = re.compile(r"^(.+)-(\d{6})$")
+# Backing-индексы data stream {common_name}-logs (режим data_stream в elk_auto_index_helm.py)
+DATA_STREAM_INDEX = re.compile(r"^\.ds-(.+)-logs-\d{4}\.\d{2}\.\d{2}-\d{6}$")
+HINT = re.compile(r"^(\d+(?:\.\d+)?)\s*gb$", re.IGNORECASE)
+
+
+def volume_class(name):
+    for row in VOLUME_CLASSES:
+        if row[0] == name:
+            return {"class": row[0], "shards": row[2], "replicas": row[3],
+                    "max_age": row[4], "max_primary_shard_size": row[5]}
+    raise ValueError(f"Unknown volume class '{name}'")
+
+
+def class_for_rate(gb_per_day):
+    for name, limit, *_ in VOLUME_CLASSES:
+        if limit is None or gb_per_day <= limit:
+            return name
+
+
+def class_limit(name):
+    return next(limit for row_name, limit, *_ in VOLUME_CLASSES if row_name == name)
+
+
+def class_rank(name):
+    return [row[0] for row in VOLUME_CLASSES].index(name)
+
+
+def parse_hint(hint):
+    """'xs' / 'm' - класс, '40gb' - ожидаемый объём в сутки. Возвращает имя класса."""
+    hint = hint.strip()
+    match = HINT.match(hint)
+    if match:
+        return class_for_rate(float(match.group(1)))
+    volume_class(hint)
+    return hint
+
+
+# Объём primary в сутки по индексам {common_name}-NNNNNN и backing-индексам data stream,
+# созданным за LOOKBACK_DAYS (backing-индексы скрытые, поэтому expand_wildcards=all)
+def measure_ingest(es):
+    rows = es.cat.indices(index="*-0*", format="json", h="index,pri.store.size,creation.date", bytes="b",
+                          expand_wildcards="all")
+    now = time.time()
+    sizes = {}
+    oldest = {}
+    for row in rows:
+        match = DATA_STREAM_INDEX.match(row["index"]) or INDEX_NAME.match(row["index"])
+        if not match or not row.get("pri.store.size") or not row.get("creation.date"):
+            continue
+        created = int(row["creation.date"]) / 1000
+        if now - created > LOOKBACK_DAYS * 86400:
+            continue
+        common_name = match.group(1)
+        sizes[common_name] = sizes.get(common_name, 0) + int(row["pri.store.size"])
+        oldest[common_name] = min(oldest.get(common_name, now), created)
+    return {name: sizes[name] / GB / ((now - oldest[name]) / 86400) for name in sizes
+            if now - oldest[name] >= MIN_OBSERVED_HOURS * 3600}
+
+
+def choose_class(common_name, hints, rates, current_class):
+    if common_name in hints:
+        return hints[common_name]
+    if common_name not in rates:
+        return current_class or DEFAULT_VOLUME_CLASS
+    measured = class_for_rate(rates[common_name])
+    if current_class and class_rank(measured) < class_rank(current_class):
+        if rates[common_name] > DOWNGRADE_RATIO * class_limit(measured):
+            return current_class
+    return measured
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import re
+
+import sizing
+
+# Описание тенантов для elk_auto_index_helm.py, читается потоком (в памяти только тенанты своего шарда).
+# Источник - файл спецификаций, по одному тенанту на строку JSONL или на документ YAML (.yaml/.yml, нужен PyYAML):
+#   {"name": "app1"}
+#   {"name": "app2", "volume": "m", "retention": "90d"}
+#   {"name": "app3", "volume": "40gb", "roles": {"read": {"privileges": ["read", "view_index_metadata"]}}}
+# volume - класс объёма или объём в сутки (sizing.py), retention - через сколько удалять индексы (ILM delete),
+# roles - замена privileges / kibana_features / kibana_spaces для отдельных типов ролей.
+# Если файла нет - строка common_name из ConfigMap: "app1, app2:xs, app3:40gb".
+#
+# Шардирование по подам Indexed Job: Kubernetes задаёт каждому поду JOB_COMPLETION_INDEX,
+# SHARD_COUNT - число подов. Под берёт тенанты, у которых sha1(имени) % SHARD_COUNT равен его индексу.
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("JOB_COMPLETION_INDEX", "0"))
+DEFAULT_RETENTION = os.getenv("DEFAULT_RETENTION", "30d")
+
+TENANT_KEYS = {"name", "volume", "retention", "roles"}
+ROLE_OVERRIDE_KEYS = {"privileges", "kibana_features", "kibana_spaces"}
+RETENTION = re.compile(r"^\d+[dh]$")
+
+
+def shard_of(name, count=None):
+    # hash() в Python случайный между процессами, поэтому sha1
+    return int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) % (count or SHARD_COUNT)
+
+
+def in_shard(name):
+    return SHARD_COUNT <= 1 or shard_of(name) == SHARD_INDEX
+
+
+# === Источники: (откуда - для сообщений об ошибках, описание тенанта) ===
+def iter_jsonl(path):
+    with open(path, 'r') as file:
+        for line_no, line in enumerate(file, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                # Разбирается в read_tenants: одна битая строка не должна останавливать весь прогон
+                yield f"{path}:{line_no}", line
+
+
+def iter_yaml(path):
+    import yaml  # только для YAML-спецификаций
+
+    with open(path, 'r') as file:
+        doc_no = 0
+        try:
+            for doc_no, doc in enumerate(yaml.safe_load_all(file), 1):
+                # Документ - один тенант или список тенантов
+                for item in doc if isinstance(doc, list) else [doc] if doc is not None else []:
+                    yield f"{path}#{doc_no}", item
+        except yaml.YAMLError as e:
+            # После синтаксической ошибки YAML дальше не читается - уже прочитанные тенанты обрабатываются
+            print(f"Skipping the rest of {path} after document {doc_no}: {e}")
+
+
+def iter_common_names(path):
+    try:
+        with open(path, 'r') as file:
+            common_names = file.read().strip()
+    except Exception as e:
+        print(f"Failed to read common_name from ConfigMap: {e}")
+        common_names = ""
+    for entry in common_names.split(','):
+        if entry.strip():
+            name, _, hint = entry.partition(':')
+            yield path, {"name": name.strip(), **({"volume": hint.strip()} if hint.strip() else {})}
+
+
+def normalize(raw, role_types):
+    if not isinstance(raw, dict):
+        raise ValueError("expected an object")
+    unknown = set(raw) - TENANT_KEYS
+    if unknown:
+        raise ValueError(f"unknown field(s) {', '.join(sorted(unknown))}")
+    name = raw.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("'name' is required")
+
+    retention = str(raw.get("retention", DEFAULT_RETENTION))
+    if not RETENTION.match(retention):
+        raise ValueError(f"retention '{retention}' must look like 30d or 12h")
+
+    roles = raw.get("roles") or {}
+    if not isinstance(roles, dict):
+        raise ValueError("'roles' must be an object keyed by role type")
+    for role_type, override in roles.items():
+        if role_type not in role_types:
+            raise ValueError(f"unknown role type '{role_type}'")
+        if not isinstance(override, dict) or set(override) - ROLE_OVERRIDE_KEYS:
+            raise ValueError(f"role '{role_type}' may only override {', '.join(sorted(ROLE_OVERRIDE_KEYS))}")
+
+    return {
+        "name": name.strip(),
+        "volume": sizing.parse_hint(str(raw["volume"])) if raw.get("volume") else None,
+        "retention": retention,
+        "roles": roles,
+    }
+
+
+def read_tenants(tenants_file, common_name_file, role_types):
+    """Тенанты своего шарда. Ошибочные записи и повторы имён пропускаются с сообщением."""
+    if tenants_file and os.path.exists(tenants_file):
+        if tenants_file.endswith((".yaml", ".yml")):
+            source, decode = iter_yaml(tenants_file), None
+        else:
+            source, decode = iter_jsonl(tenants_file), json.loads
+    else:
+        source, decode = iter_common_names(common_name_file), None
+
+    seen = set()
+    for where, raw in source:
+        try:
+            # JSONDecodeError - подкласс ValueError
+            tenant = normalize(decode(raw) if decode else raw, role_types)
+        except ValueError as e:
+            print(f"Skipping tenant at {where}: {e}")
+            continue
+        if not in_shard(tenant["name"]):
+            continue
+        if tenant["name"] in seen:
+            print(f"Skipping tenant at {where}: duplicate name '{tenant['name']}'")
+            continue
+        seen.add(tenant["name"])
+        yield tenant
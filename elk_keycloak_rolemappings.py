@@ -1,8 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import ApiError, Elasticsearch, NotFoundError
 import requests
+import logging
+import math
+import time
 import json
 import urllib3
 import os
 
+from keycloak_client import KeycloakAdmin
+from run_state import RunState
+import run_metrics
+
 # Отключаем предупреждения о небезопасном SSL (если используется self-signed)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -18,79 +27,85 @@ ES_URL = os.getenv("ES_URL")
 ES_USER = os.getenv("ES_USER")
 ES_PASSWORD = os.getenv("ES_PASSWORD")
 
-TARGET_GROUP_PATH = os.getenv("TARGET_GROUP_PATH")  # Например: /kibana
+TARGET_GROUP_PATH = os.getenv("TARGET_GROUP_PATH", "")  # Например: /kibana
 
 # Читаем суффиксы из ROLE_SUFFIXE, разбиваем и очищаем от пробелов
-ROLE_SUFFIXES = [suffix.strip() for suffix in os.getenv("ROLE_SUFFIX").split(",")]
-
-
-# === Получение админ-токена Keycloak ===
-def get_kc_admin_token():
-    url = f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token"
-    data = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "username": ADMIN_USER,
-        "password": ADMIN_PASSWORD,
-        "grant_type": "password",
-    }
+ROLE_SUFFIXES = [suffix.strip() for suffix in os.getenv("ROLE_SUFFIX", "").split(",")]
+
+PAGE_SIZE = 100
+# Сколько запросов children выполняется параллельно при обходе дерева групп
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+# Метка в metadata маппингов, которыми управляет этот скрипт
+MANAGED_BY = "elk_keycloak_rolemappings"
+# per_group - role_mapping на каждую группу с суффиксом (роль = имя группы);
+# templated - один role_mapping на realm с mustache role_templates: роли берутся из claim groups
+#             пользователя (роль = полный путь группы, такие роли создаёт elk_auto_index_helm.py в том же режиме)
+ROLE_MAPPING_MODE = os.getenv("ROLE_MAPPING_MODE", "per_group")
+# Сколько role_mapping пишется в ES параллельно
+ES_WRITE_WORKERS = int(os.getenv("ES_WRITE_WORKERS", "4"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+log = logging.getLogger("elk_keycloak_rolemappings")
+
+
+# === Клиент Keycloak Admin API (токен берётся и обновляется внутри) ===
+def get_kc_admin_client():
+    kc = KeycloakAdmin(KEYCLOAK_URL, "master", CLIENT_ID, CLIENT_SECRET, ADMIN_USER, ADMIN_PASSWORD,
+                       pool_size=MAX_WORKERS)
     try:
-        response = requests.post(url, data=data, verify=False)
-        response.raise_for_status()
-        return response.json()["access_token"]
+        kc.token()
     except requests.exceptions.RequestException as e:
-        print(f"[ERROR] Не удалось получить токен Keycloak: {e}")
-        if response.text:
-            print(f"Ответ сервера: {response.text}")
+        log.error("Не удалось получить токен Keycloak: %s", e)
+        if e.response is not None and e.response.text:
+            log.error("Ответ сервера: %s", e.response.text)
         exit(1)
+    return kc
 
 
-# === Рекурсивное получение всех групп ===
-def get_all_groups(token):
-    url = f"{KEYCLOAK_URL}/admin/realms/{REALM}/groups"
-    headers = {"Authorization": f"Bearer {token}"}
+# === Получение поддерева TARGET_GROUP_PATH ===
+# Корневая группа пути ищется через ?search= с exact=true: Keycloak отдаёт её с поддеревом subGroups,
+# и целевая группа берётся из него без обхода. Если поддерево не пришло (версии, отдающие только
+# subGroupCount) - group-by-path, и walk_groups дочитывает подгруппы по GET на группу с подгруппами.
+def find_target_group(kc):
+    target = "/" + TARGET_GROUP_PATH.strip("/")
+    root_name = target.strip("/").split("/")[0]
+    level = kc.get_paged(f"/{REALM}/groups", PAGE_SIZE, search=root_name, exact="true", briefRepresentation="true")
+    while level:
+        group = next((g for g in level if target == g.get("path") or target.startswith(f"{g.get('path')}/")), None)
+        if group is None:
+            break
+        if group["path"] == target:
+            return group
+        level = group.get("subGroups") or []
+
+    response = kc.get(f"/{REALM}/group-by-path/{target.strip('/')}")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.json()
 
-    def fetch_children(group_id, headers):
-        try:
-            response = requests.get(
-                f"{url}/{group_id}/children",
-                headers=headers,
-                verify=False
-            )
-            response.raise_for_status()
-            groups = response.json()
-            all_groups = []
-            for group in groups:
-                all_groups.append(group)
-                # Рекурсивно получаем дочерние группы
-                children = fetch_children(group['id'], headers)
-                if children:
-                    all_groups.extend(children)
-            return all_groups
-        except Exception as e:
-            print(f"[ERROR] Ошибка при получении подгрупп: {e}")
-            return []
 
-    # Сначала получаем корневые группы
-    root_groups = requests.get(url, headers=headers, verify=False).json()
+# Возвращает (группы, полный ли обход). По неполному обходу нельзя удалять маппинги.
+def get_target_groups(kc):
+    target = find_target_group(kc)
+    if target is None:
+        log.error("Группа '%s' не найдена в реалме '%s'", TARGET_GROUP_PATH, REALM)
+        return [], False
 
-    # Запускаем рекурсивный сбор всех групп
-    all_groups = []
-    for group in root_groups:
-        all_groups.append(group)
-        children = fetch_children(group['id'], headers)
-        if children:
-            all_groups.extend(children)
+    groups, errors = kc.walk_groups(REALM, [target], PAGE_SIZE, max_workers=MAX_WORKERS)
+    for group, error in errors:
+        log.error("Ошибка при получении подгрупп '%s': %s", group.get('path'), error)
+    return groups, not errors
 
-    return all_groups
 
+# === Желаемый role_mapping для группы ===
+# Свои маппинги помечаем в metadata, чтобы удалять только их и только в рамках своего realm/группы
+def managed_metadata():
+    return {"managed_by": MANAGED_BY, "realm": REALM, "target_group_path": TARGET_GROUP_PATH}
 
-# === Создание/обновление role_mapping в Elasticsearch ===
-def create_role_mapping(group_path, role_name):
-    mapping_name = role_name  # имя маппинга = имя роли
-    url = f"{ES_URL}/_security/role_mapping/{mapping_name}"
 
-    body = {
+def desired_role_mapping(group_path, role_name):
+    return {
         "roles": [role_name],
         "enabled": True,
         "rules": {
@@ -98,63 +113,266 @@ def create_role_mapping(group_path, role_name):
                 {"field": {"realm.name": REALM}},
                 {"field": {"groups": group_path}}
             ]
-        }
+        },
+        "metadata": managed_metadata()
+    }
+
+
+# Режим templated: один маппинг на realm. Шаблон отдаёт все группы пользователя как имена ролей;
+# ES игнорирует несуществующие роли, а роли с именем-путём группы есть только у управляемых групп.
+# Шаблон не фильтрует группы, поэтому маппинг на каждый суффикс выдал бы те же роли -
+# суффиксы объединены через any в правиле одного маппинга
+def templated_mapping_name():
+    return f"{MANAGED_BY}-{REALM}"
+
+
+def desired_templated_mapping(suffixes):
+    return {
+        "role_templates": [
+            {"template": {"source": "{{#tojson}}groups{{/tojson}}"}, "format": "json"}
+        ],
+        "enabled": True,
+        "rules": {
+            "all": [
+                {"field": {"realm.name": REALM}},
+                {"any": [{"field": {"groups": f"/{TARGET_GROUP_PATH.strip('/')}/*/*{suffix}"}}
+                         for suffix in suffixes]}
+            ]
+        },
+        "metadata": dict(managed_metadata(), mode="templated")
     }
 
-    print(f"\n[INFO] Создаю маппинг: '{mapping_name}' для группы '{group_path}'")
-    print(f"Тело запроса:\n{json.dumps(body, indent=2)}")
 
+# Маппинги обоих режимов считаются своими: при смене режима маппинги другого режима удаляются
+def is_managed(mapping):
+    metadata = mapping.get("metadata") or {}
+    return all(metadata.get(key) == value for key, value in managed_metadata().items())
+
+
+# === Клиент Elasticsearch (keep-alive, пул на ES_WRITE_WORKERS соединений) ===
+# В едином процессе (elk_kk_reconcile.py) клиент передаётся снаружи - общий со стадией elk-auto-index
+def make_es_client():
+    es = Elasticsearch([ES_URL], basic_auth=(ES_USER, ES_PASSWORD), verify_certs=False,
+                       connections_per_node=ES_WRITE_WORKERS)
+    return run_metrics.instrument_es(es)
+
+
+# === Текущие role_mapping в Elasticsearch (один запрос) ===
+def get_role_mappings(es):
     try:
-        response = requests.put(
-            url,
-            auth=(ES_USER, ES_PASSWORD),
-            headers={"Content-Type": "application/json"},
-            json=body,
-            verify=False,
-        )
-        print(f"[INFO] Статус: {response.status_code}, Ответ: {response.text}")
-
-        if response.status_code in (200, 201):
-            print(f"[SUCCESS] Маппинг '{mapping_name}' успешно создан.")
+        return dict(es.security.get_role_mapping())
+    except NotFoundError:
+        return {}
+
+
+# === Запись / удаление одного role_mapping ===
+# Возвращает (успех, задержка в секундах) и пишет одну строку лога на маппинг
+def apply_role_mapping(es, mapping_name, body):
+    action = "delete" if body is None else "put"
+    started = time.monotonic()
+    try:
+        if body is None:
+            response = es.security.delete_role_mapping(name=mapping_name)
         else:
-            print(f"[ERROR] Не удалось создать маппинг.")
+            response = es.security.put_role_mapping(name=mapping_name, body=body)
+        ok, status = True, response.meta.status
+    except NotFoundError as e:
+        # Уже удалён
+        ok, status = body is None, e.meta.status
+        log.debug("mapping=%s error=%s", mapping_name, e)
+    except ApiError as e:
+        ok, status = False, e.meta.status
+        log.debug("mapping=%s response=%s", mapping_name, e.body)
     except Exception as e:
-        print(f"[ERROR] Исключение при вызове Elasticsearch: {e}")
+        ok, status = False, type(e).__name__
+        log.debug("mapping=%s error=%s", mapping_name, e)
+    latency = time.monotonic() - started
+
+    if ok:
+        log.info("mapping=%s action=%s status=%s latency_ms=%.1f", mapping_name, action, status, latency * 1000)
+    else:
+        log.error("mapping=%s action=%s status=%s latency_ms=%.1f", mapping_name, action, status, latency * 1000)
+    if body is not None:
+        log.debug("mapping=%s body=%s", mapping_name, json.dumps(body))
+    return ok, latency
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+# === Сравнение желаемых маппингов с текущими ===
+# ES хранит role_templates[].template строкой JSON, а не объектом из PUT - перед сравнением разбираем
+def normalize_mapping(mapping):
+    templates = []
+    for role_template in mapping.get("role_templates") or []:
+        template = role_template.get("template")
+        if isinstance(template, str):
+            try:
+                template = json.loads(template)
+            except ValueError:
+                pass
+        templates.append(dict(role_template, template=template))
+    return dict(mapping, role_templates=templates) if "role_templates" in mapping else mapping
+
+
+def diff_role_mappings(desired, current):
+    to_write = {}
+    for name, body in desired.items():
+        existing = current.get(name)
+        existing = normalize_mapping(existing) if existing is not None else None
+        if existing is None or any(existing.get(key) != value for key, value in body.items()):
+            to_write[name] = body
+    stale = [name for name, mapping in current.items() if name not in desired and is_managed(mapping)]
+    return to_write, stale
+
+
+# === Режим templated ===
+# Один маппинг на realm, группы Keycloak не обходятся: один GET маппингов на прогон.
+# Миграция с per_group: маппинг группы удаляется, только когда в ES уже есть роль с именем-путём этой
+# группы (её создаёт elk_auto_index_helm.py), иначе пользователи на время потеряли бы доступ.
+def legacy_group_path(mapping):
+    for rule in mapping.get("rules", {}).get("all", []):
+        group = rule.get("field", {}).get("groups")
+        if group:
+            return group
+    return None
+
+
+def get_role_names(es):
+    return set(es.security.get_role())
+
+
+def sync_templated(es):
+    suffixes = [suffix for suffix in ROLE_SUFFIXES if suffix]
+    desired = {templated_mapping_name(): desired_templated_mapping(suffixes)} if suffixes else {}
+    try:
+        current = get_role_mappings(es)
+    except Exception as e:
+        log.error("Не удалось получить role_mapping из Elasticsearch: %s", e)
+        exit(1)
+    to_write, stale = diff_role_mappings(desired, current)
+
+    legacy = [name for name in stale if current[name].get("metadata", {}).get("mode") != "templated"]
+    waiting = []
+    if legacy:
+        try:
+            roles = get_role_names(es)
+        except Exception as e:
+            log.error("Не удалось получить роли из Elasticsearch: %s", e)
+            exit(1)
+        waiting = [name for name in legacy if legacy_group_path(current[name]) not in roles]
+        stale = [name for name in stale if name not in waiting]
+    log.info("mode=templated desired=%d to_write=%d stale=%d migration_waiting=%d",
+             len(desired), len(to_write), len(stale), len(waiting))
+    for name in waiting:
+        log.info("mapping=%s action=keep reason=role '%s' not created yet", name, legacy_group_path(current[name]))
+
+    # Сначала шаблонные маппинги, потом удаление старых: доступ не пропадает между шагами
+    with ThreadPoolExecutor(max_workers=ES_WRITE_WORKERS) as pool:
+        results = list(pool.map(lambda item: apply_role_mapping(es, *item), to_write.items()))
+        if all(ok for ok, _ in results):
+            results += list(pool.map(lambda name: apply_role_mapping(es, name, None), stale))
+    return desired, results
+
+
+# === Логирование ===
+# Обработчик вешается на свой логгер, а не на корневой: в едином процессе (elk_kk_reconcile.py,
+# контроллер) basicConfig включил бы INFO и для elastic_transport - строку на каждый запрос к ES
+def setup_logging():
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        log.addHandler(handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
 
 
 # === Основная логика ===
-def main():
-    print("[INFO] Запуск синхронизации маппингов ролей...")
+# kc, es и group_paths передаёт единый процесс (elk_kk_reconcile.py): общие клиенты Keycloak и ES
+# и уже известное дерево групп из стадии keycloak_groups_roles вместо повторного обхода
+def main(kc=None, group_paths=None, es=None):
+    setup_logging()
+    log.info("Запуск синхронизации маппингов ролей...")
 
-    # Шаг 1: Получаем токен
-    token = get_kc_admin_token()
+    if ROLE_MAPPING_MODE == "templated":
+        desired, results = sync_templated(es or make_es_client())
+        latencies = [latency for _, latency in results]
+        failed = sum(1 for ok, _ in results if not ok)
+        log.info("summary total=%d changed=%d failed=%d p95_ms=%.1f",
+                 len(desired), len(results) - failed, failed, percentile(latencies, 95) * 1000)
+        if failed:
+            exit(1)
+        return
 
-    # Шаг 2: Получаем все группы
-    groups = get_all_groups(token)
-    group_paths = [g["path"] for g in groups if g.get("path")]
+    if group_paths is not None:
+        complete = True
+        log.info("groups=%d source=pipeline", len(group_paths))
+    else:
+        # Шаг 1: Клиент Keycloak с токеном
+        kc = kc or get_kc_admin_client()
 
-    print(f"[INFO] Найдено {len(group_paths)} групп:")
+        # Шаг 2: Получаем группы из поддерева TARGET_GROUP_PATH
+        started = time.monotonic()
+        groups, complete = get_target_groups(kc)
+        group_paths = [g["path"] for g in groups if g.get("path")]
+        log.info("groups=%d crawl_ms=%.1f", len(group_paths), (time.monotonic() - started) * 1000)
     for path in group_paths:
-        print(f" - {path}")
-
-    # Фильтруем по базовому префиксу (например, /kibana)
-    filtered_paths = [p for p in group_paths if p.startswith(TARGET_GROUP_PATH)]
-    print(f"[INFO] После фильтрации по {TARGET_GROUP_PATH}: {len(filtered_paths)}")
+        log.debug("group=%s", path)
 
     # Ищем группы, заканчивающиеся на нужный суффикс
-    mappings_to_create = []
-    for path in filtered_paths:
+    desired = {}
+    for path in group_paths:
         group_name = path.split("/")[-1]  # например: subgroupAadmin
         if any(group_name.endswith(suffix) for suffix in ROLE_SUFFIXES):
-            mappings_to_create.append({
-                "path": path,
-                "role": group_name
-            })
+            desired[group_name] = desired_role_mapping(path, group_name)  # имя маппинга = имя роли
+
+    # Шаг 3: Определяем, что писать. При полной сверке (раз в FULL_VERIFY_HOURS или без хранилища
+    # состояния) сравниваем с ES, иначе - с отпечатками маппингов из прошлого прогона, без запросов в ES
+    es = es or make_es_client()
+    state = RunState("elk_keycloak_rolemappings")
+    full_verify = state.full_verify_due()
+    if full_verify:
+        try:
+            current = get_role_mappings(es)
+        except Exception as e:
+            log.error("Не удалось получить role_mapping из Elasticsearch: %s", e)
+            exit(1)
+        to_write, stale = diff_role_mappings(desired, current)
+    else:
+        to_write = {name: desired[name] for name in state.changed(desired)}
+        stale = state.removed(desired)
+    if not complete:
+        log.warning("Дерево групп прочитано не полностью, удаление устаревших маппингов пропущено.")
+        stale = []
+    log.info("desired=%d to_write=%d stale=%d unchanged=%d full_verify=%s",
+             len(desired), len(to_write), len(stale), len(desired) - len(to_write), full_verify)
+
+    # Шаг 4: Пишем только разницу, параллельно
+    changes = list(to_write.items()) + [(name, None) for name in stale]
+    with ThreadPoolExecutor(max_workers=ES_WRITE_WORKERS) as pool:
+        results = list(pool.map(lambda item: apply_role_mapping(es, *item), changes))
 
-    print(f"[INFO] Подходящих групп для маппинга: {len(mappings_to_create)}")
-    for item in mappings_to_create:
-        create_role_mapping(item["path"], item["role"])
+    for name, body in desired.items():
+        if name not in to_write:
+            state.mark_applied(name, body)
+    for (name, body), (ok, _) in zip(changes, results):
+        if ok and body is None:
+            state.forget(name)
+        elif ok:
+            state.mark_applied(name, body)
 
+    latencies = [latency for _, latency in results]
+    failed = sum(1 for ok, _ in results if not ok)
+    state.save(full_verify=full_verify and complete and not failed)
+    log.info("summary total=%d changed=%d failed=%d p95_ms=%.1f",
+             len(desired), len(changes) - failed, failed, percentile(latencies, 95) * 1000)
+    if failed:
+        exit(1)
 
 if __name__ == "__main__":
-    main()
+    with run_metrics.run("elk_keycloak_rolemappings"):
+        main()
@@ -0,0 +1,116 @@
+import os
+import signal
+import threading
+import time
+
+import elk_auto_index_helm
+import elk_keycloak_rolemappings
+import elk_kk_reconcile
+import keycloak_groups_roles
+import run_metrics
+import run_state
+
+# Режим контроллера: вместо ручного запуска CronJob процесс живёт постоянно, следит за файлами
+# смонтированного unified-config (/etc/config) и запускает сверку, как только они поменялись.
+# Kubernetes обновляет смонтированный ConfigMap атомарной подменой каталога ..data, поэтому
+# достаточно раз в POLL_SECONDS сравнивать отпечаток содержимого файлов (без inotify и доступа к API).
+# Состояние прошлых прогонов (run_state) хранится в памяти процесса, поэтому при добавлении
+# common_name сверяются только новые тенанты, поддеревья групп и маппинги.
+
+CONFIG_DIR = os.getenv("CONFIG_DIR", "/etc/config")
+POLL_SECONDS = float(os.getenv("POLL_SECONDS", "5"))
+# Сверка без изменений конфига (ловит ручные правки в ES/Keycloak вместе с FULL_VERIFY_HOURS)
+RESYNC_MINUTES = float(os.getenv("RESYNC_MINUTES", "60"))
+# Пауза перед повтором после неудачного прогона
+RETRY_SECONDS = float(os.getenv("RETRY_SECONDS", "60"))
+
+# Ключи unified-config, которые подхватываются без перезапуска.
+# Адреса и учётные данные читаются из окружения при старте, их смена требует рестарта пода.
+WATCHED_KEYS = ["GROUPS_TO_CREATE", "SUBGROUPS", "ROLE_SUFFIX", "TARGET_GROUP_PATH", "ROLE_MAPPING_MODE", "common_name",
+                "tenants.jsonl"]
+
+stop = threading.Event()
+
+
+def read_config():
+    config = {}
+    for key in WATCHED_KEYS:
+        try:
+            with open(os.path.join(CONFIG_DIR, key), 'r') as file:
+                config[key] = file.read().strip()
+        except FileNotFoundError:
+            config[key] = os.getenv(key, "")
+    return config
+
+
+# Переносим значения из конфига в модули стадий (они читают окружение один раз при импорте)
+def apply_config(config):
+    keycloak_groups_roles.GROUPS_TO_CREATE = config["GROUPS_TO_CREATE"].split()
+    keycloak_groups_roles.SUBGROUPS = config["SUBGROUPS"].split()
+    keycloak_groups_roles.ROLE_SUFFIX = config["ROLE_SUFFIX"]
+
+    elk_keycloak_rolemappings.TARGET_GROUP_PATH = config["TARGET_GROUP_PATH"]
+    elk_keycloak_rolemappings.ROLE_SUFFIXES = [suffix.strip() for suffix in config["ROLE_SUFFIX"].split(",")]
+    elk_keycloak_rolemappings.ROLE_MAPPING_MODE = config["ROLE_MAPPING_MODE"] or "per_group"
+
+    elk_auto_index_helm.target_group_path = config["TARGET_GROUP_PATH"].strip().strip('/')
+    elk_auto_index_helm.ROLE_MAPPING_MODE = config["ROLE_MAPPING_MODE"] or "per_group"
+    elk_auto_index_helm.COMMON_NAME_FILE = os.path.join(CONFIG_DIR, "common_name")
+    elk_auto_index_helm.TENANTS_FILE = os.path.join(CONFIG_DIR, "tenants.jsonl")
+
+
+def run_once(kc, es, reason):
+    print(f"\n##### Reconcile ({reason}) #####")
+    started = time.monotonic()
+    try:
+        # Счётчики накапливаются за всё время работы, выгружаются после каждого прогона
+        with run_metrics.run("elk_kk_controller"):
+            elk_kk_reconcile.reconcile(kc, es)
+    except SystemExit as e:
+        # Стадии завершаются через exit(1) при ошибках, в контроллере это просто неудачный прогон
+        print(f"##### Reconcile failed (exit code {e.code}), retry in {RETRY_SECONDS:.0f}s #####")
+        return False
+    except Exception as e:
+        print(f"##### Reconcile failed: {e}, retry in {RETRY_SECONDS:.0f}s #####")
+        return False
+    print(f"##### Reconcile done in {time.monotonic() - started:.1f}s #####")
+    return True
+
+
+def main():
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    if not (run_state.STATE_CONFIGMAP or run_state.STATE_FILE):
+        run_state.memory_backend = run_state.MemoryBackend()
+
+    # Клиенты Keycloak (токен и пул соединений) и Elasticsearch живут всё время работы контроллера
+    kc = keycloak_groups_roles.get_admin_client()
+    es = elk_auto_index_helm.make_es_client()
+
+    applied_fingerprint = None
+    next_run = 0.0
+    reason = "startup"
+    while not stop.is_set():
+        config = read_config()
+        config_fingerprint = run_state.fingerprint(config)
+        if config_fingerprint != applied_fingerprint:
+            reason = "startup" if applied_fingerprint is None else "config changed"
+            next_run = 0.0
+
+        if time.monotonic() >= next_run:
+            apply_config(config)
+            applied_fingerprint = config_fingerprint
+            if run_once(kc, es, reason):
+                next_run, reason = time.monotonic() + RESYNC_MINUTES * 60, "resync"
+            else:
+                # Повторяем после паузы, новое изменение конфига запустит прогон сразу
+                next_run, reason = time.monotonic() + RETRY_SECONDS, "retry"
+
+        stop.wait(POLL_SECONDS)
+
+    print("Controller stopped.")
+
+
+if __name__ == "__main__":
+    main()
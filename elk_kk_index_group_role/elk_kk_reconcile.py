@@ -0,0 +1,50 @@
+import time
+
+import elk_auto_index_helm
+import elk_keycloak_rolemappings
+import keycloak_groups_roles
+import run_metrics
+
+# Единый процесс вместо трёх CronJob: группы и роли в Keycloak -> role_mapping в ES ->
+# ILM/шаблоны/индексы/роли/data view для common_name.
+# Стадии используют один клиент Keycloak (один токен и пул соединений) и один клиент Elasticsearch
+# (пул и учётные данные elk-auto-index: ES_HOST/USERNAME/ELK_PASSWORD), а дерево групп,
+# загруженное первой стадией, передаётся во вторую вместо повторного обхода Keycloak.
+# Список тенантов нужен только стадии elk-auto-index: стадии Keycloak создают группы по GROUPS_TO_CREATE/SUBGROUPS.
+
+
+def target_group_paths(group_index):
+    """Пути групп из поддерева TARGET_GROUP_PATH, если первая стадия загрузила его целиком."""
+    if group_index is None or keycloak_groups_roles.NEW_REALM != elk_keycloak_rolemappings.REALM:
+        return None
+    target = "/" + elk_keycloak_rolemappings.TARGET_GROUP_PATH.strip("/")
+    # load_group_index загружает корневые группы вместе со всеми потомками
+    root = "/" + target.strip("/").split("/")[0]
+    if root not in group_index:
+        return None
+    return [path for path in group_index if path == target or path.startswith(f"{target}/")]
+
+
+def run_stage(name, func, *args, **kwargs):
+    print(f"\n===== {name} =====")
+    started = time.monotonic()
+    result = func(*args, **kwargs)
+    print(f"===== {name}: {time.monotonic() - started:.1f}s =====")
+    return result
+
+
+# Один прогон всех стадий. kc и es живут дольше прогона в режиме контроллера (elk_kk_controller.py)
+def reconcile(kc, es):
+    group_index = run_stage("keycloak-groups-roles", keycloak_groups_roles.main, kc)
+    run_stage("keycloak-es-rolemapping", elk_keycloak_rolemappings.main,
+              kc=kc, group_paths=target_group_paths(group_index), es=es)
+    run_stage("elk-auto-index", elk_auto_index_helm.main, es=es)
+
+
+def main():
+    reconcile(keycloak_groups_roles.get_admin_client(), elk_auto_index_helm.make_es_client())
+
+
+if __name__ == "__main__":
+    with run_metrics.run("elk_kk_reconcile"):
+        main()
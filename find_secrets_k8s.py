@@ -0,0 +1,267 @@
+# Поиск использования секретов в Kubernetes
+# Каждый вид ресурсов читается один раз, постранично (limit/continue), виды - параллельно.
+# За один проход по объекту собираются все ссылки на секреты: env/envFrom всех контейнеров
+# (включая initContainers и ephemeralContainers), тома secret/projected/csi и imagePullSecrets,
+# в том числе внутри .spec.template и .spec.jobTemplate.
+# Вместо живого кластера можно передать сохранённый дамп: kubectl get ... -A -o json > dump.json
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import subprocess
+import sys
+import urllib.parse
+
+# Вид ресурса -> путь в API (как у kubectl get --raw)
+KINDS = {
+    "Pod": ("/api/v1", "pods"),
+    "Deployment": ("/apis/apps/v1", "deployments"),
+    "StatefulSet": ("/apis/apps/v1", "statefulsets"),
+    "DaemonSet": ("/apis/apps/v1", "daemonsets"),
+    "CronJob": ("/apis/batch/v1", "cronjobs"),
+    "Job": ("/apis/batch/v1", "jobs"),
+}
+# Пути для list/watch: рабочие нагрузки и сами секреты (нужны индексу secret_index.py)
+API_PATHS = {**KINDS, "Secret": ("/api/v1", "secrets")}
+CHUNK_SIZE = 500
+# Размер блока при потоковом чтении дампа
+READ_SIZE = 1024 * 1024
+
+
+# === Чтение объектов из кластера ===
+def list_url(kind, namespace=None, chunk_size=CHUNK_SIZE, continue_token=None):
+    prefix, resource = API_PATHS[kind]
+    path = f"{prefix}/namespaces/{namespace}/{resource}" if namespace else f"{prefix}/{resource}"
+    params = {"limit": chunk_size}
+    if continue_token:
+        params["continue"] = continue_token
+    return f"{path}?{urllib.parse.urlencode(params)}"
+
+
+def kubectl_raw(url, context=None):
+    cmd = ["kubectl", "get", "--raw", url]
+    if context:
+        cmd += ["--context", context]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"kubectl get --raw {url}: {result.stderr.strip()}")
+    return json.loads(result.stdout)
+
+
+# Страницы по chunk_size объектов: в памяти держим только текущую страницу.
+# Элементы списка в ответе API не содержат kind, поэтому возвращаем его вместе с объектом
+def iter_cluster_objects(kind, namespace=None, chunk_size=CHUNK_SIZE, context=None):
+    continue_token = None
+    while True:
+        page = kubectl_raw(list_url(kind, namespace, chunk_size, continue_token), context)
+        for obj in page.get("items", []):
+            yield kind, obj
+        continue_token = page.get("metadata", {}).get("continue")
+        if not continue_token:
+            return
+
+
+# === Чтение объектов из дампа ===
+# Дамп - вывод kubectl get -o json (List с массивом items). Файл читается блоками,
+# объекты разбираются по одному, весь дамп в память не загружается.
+def iter_dump_objects(path):
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as file:
+        buffer = ""
+        position = -1
+        while position == -1:
+            chunk = file.read(READ_SIZE)
+            if not chunk:
+                position = None
+                break
+            buffer += chunk
+            position = find_items_start(buffer)
+        if position is None:
+            # Один объект, а не List
+            with open(path, 'r') as single:
+                obj = json.load(single)
+            yield obj.get("kind"), obj
+            return
+
+        while True:
+            # Пропускаем пробелы и запятые между элементами
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if position < len(buffer):
+                    break
+                chunk = file.read(READ_SIZE)
+                if not chunk:
+                    return
+                buffer, position = chunk, 0
+            if buffer[position] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                chunk = file.read(READ_SIZE)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield obj.get("kind"), obj
+            position = end
+
+
+# Позиция сразу после "[" массива items корневого объекта; -1 - нужно дочитать файл; None - в корне нет items.
+# Ключи ищутся только на верхнем уровне: "items" бывает и внутри объекта (тома configMap/projected)
+def find_items_start(buffer):
+    decoder = json.JSONDecoder()
+    position = skip_chars(buffer, 0, " \t\r\n")
+    if position >= len(buffer):
+        return -1
+    if buffer[position] != "{":
+        return None
+    position += 1
+    while True:
+        position = skip_chars(buffer, position, " \t\r\n,")
+        if position >= len(buffer):
+            return -1
+        if buffer[position] == "}":
+            return None
+        try:
+            key, position = decoder.raw_decode(buffer, position)
+            position = skip_chars(buffer, position, " \t\r\n:")
+            if position >= len(buffer):
+                return -1
+            if key == "items":
+                return position + 1 if buffer[position] == "[" else None
+            # Значение остальных ключей (kind, metadata) пропускаем целиком
+            _, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Ключ или значение обрезаны концом блока
+            return -1
+
+
+def skip_chars(buffer, position, chars):
+    while position < len(buffer) and buffer[position] in chars:
+        position += 1
+    return position
+
+
+# === Извлечение ссылок на секреты (один проход по объекту) ===
+def pod_spec(obj):
+    spec = obj.get("spec") or {}
+    if "jobTemplate" in spec:
+        spec = ((spec["jobTemplate"].get("spec") or {}).get("template") or {}).get("spec") or {}
+    elif "template" in spec:
+        spec = spec["template"].get("spec") or {}
+    return spec
+
+
+# Возвращает пары (имя секрета, откуда ссылка)
+def secret_refs(obj):
+    spec = pod_spec(obj)
+    refs = set()
+
+    for group in ("initContainers", "containers", "ephemeralContainers"):
+        for container in spec.get(group) or []:
+            for env in container.get("env") or []:
+                ref = (env.get("valueFrom") or {}).get("secretKeyRef")
+                if ref and ref.get("name"):
+                    refs.add((ref["name"], "env"))
+            for env_from in container.get("envFrom") or []:
+                ref = env_from.get("secretRef")
+                if ref and ref.get("name"):
+                    refs.add((ref["name"], "envFrom"))
+
+    for volume in spec.get("volumes") or []:
+        if (volume.get("secret") or {}).get("secretName"):
+            refs.add((volume["secret"]["secretName"], "volume"))
+        for source in (volume.get("projected") or {}).get("sources") or []:
+            if (source.get("secret") or {}).get("name"):
+                refs.add((source["secret"]["name"], "projected"))
+        ref = (volume.get("csi") or {}).get("nodePublishSecretRef")
+        if ref and ref.get("name"):
+            refs.add((ref["name"], "csi"))
+
+    for ref in spec.get("imagePullSecrets") or []:
+        if ref.get("name"):
+            refs.add((ref["name"], "imagePullSecret"))
+
+    return refs
+
+
+# Строки (namespace/секрет, откуда ссылка, Kind/namespace/имя объекта) по потоку объектов
+def scan(objects):
+    usages = set()
+    for kind, obj in objects:
+        metadata = obj.get("metadata") or {}
+        namespace = metadata.get("namespace", "")
+        owner = f"{kind}/{namespace}/{metadata.get('name')}"
+        for secret_name, source in secret_refs(obj):
+            usages.add((f"{namespace}/{secret_name}", source, owner))
+    return usages
+
+
+def scan_cluster(kinds, namespace=None, chunk_size=CHUNK_SIZE, context=None):
+    with ThreadPoolExecutor(max_workers=len(kinds)) as pool:
+        results = pool.map(lambda kind: scan(iter_cluster_objects(kind, namespace, chunk_size, context)), kinds)
+        return set().union(*results)
+
+
+# Вывод прежнего jq-скрипта find_secrets_k8s.sh: две секции с уникальными именами секретов без namespace -
+# из env (secretKeyRef) и из томов secret. Остальные виды ссылок (envFrom, projected, csi, imagePullSecrets)
+# в этом формате не выводятся
+def print_legacy(usages):
+    print("Поиск секретов в переменных окружения...")
+    for name in sorted({secret.split("/", 1)[1] for secret, source, _ in usages if source == "env"}):
+        print(name)
+    print("Поиск секретов в томах...")
+    for name in sorted({secret.split("/", 1)[1] for secret, source, _ in usages if source == "volume"}):
+        print(name)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Поиск использования секретов в Kubernetes")
+    parser.add_argument("--from-file", action="append", help="дамп kubectl get -o json вместо кластера (можно несколько)")
+    parser.add_argument("-n", "--namespace", help="только один namespace (по умолчанию все)")
+    parser.add_argument("--context", help="контекст kubeconfig")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="виды ресурсов через запятую")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="объектов на страницу (limit)")
+    parser.add_argument("--names-only", action="store_true", help="вывести только уникальные namespace/секрет")
+    parser.add_argument("--output", choices=["tsv", "legacy"], default="tsv",
+                        help="tsv - namespace/секрет, откуда ссылка, объект; "
+                             "legacy - формат прежнего find_secrets_k8s.sh (по умолчанию в нём)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    kinds = [kind.strip() for kind in args.kinds.split(",") if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in KINDS]
+    if unknown:
+        print(f"Неизвестные виды ресурсов: {', '.join(unknown)}", file=sys.stderr)
+        exit(1)
+
+    if args.from_file:
+        usages = set()
+        for path in args.from_file:
+            usages |= scan((kind, obj) for kind, obj in iter_dump_objects(path)
+                           if kind in kinds and (not args.namespace
+                                                 or obj.get("metadata", {}).get("namespace") == args.namespace))
+    else:
+        try:
+            usages = scan_cluster(kinds, args.namespace, args.chunk_size, args.context)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+
+    if args.output == "legacy":
+        print_legacy(usages)
+        return
+    if args.names_only:
+        for secret in sorted({secret for secret, _, _ in usages}):
+            print(secret)
+        return
+    for secret, source, owner in sorted(usages):
+        print(f"{secret}\t{source}\t{owner}")
+
+
+if __name__ == "__main__":
+    main()
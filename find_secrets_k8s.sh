@@ -1,23 +1,12 @@
 #!/bin/bash
 
 # Скрипт для поиска использования секретов в Kubernetes
-
-# Функция для поиска секретов в переменных окружения
-find_secrets_in_env() {
-  echo "Поиск секретов в переменных окружения..."
-  kubectl get pods,deployments,statefulsets,daemonsets,cronjobs,jobs --all-namespaces -o json | \
-  jq -r '.items[] | .spec.containers[]? | .env? // empty | .[] | select(.valueFrom.secretKeyRef?) | .valueFrom.secretKeyRef.name' | \
-  sort | uniq
-}
-
-# Функция для поиска секретов в томах
-find_secrets_in_volumes() {
-  echo "Поиск секретов в томах..."
-  kubectl get pods,deployments,statefulsets,daemonsets,cronjobs,jobs --all-namespaces -o json | \
-  jq -r '.items[] | .spec.volumes[]? | select(.secret?) | .secret.secretName' | \
-  sort | uniq
-}
-
-# Запуск функций
-find_secrets_in_env
-find_secrets_in_volumes
+# Логика перенесена в find_secrets_k8s.py (один проход по каждому виду ресурсов, постранично).
+# По умолчанию вывод в прежнем формате: секция env и секция томов, уникальные имена секретов.
+# Теперь секреты ищутся и в шаблонах Deployment/StatefulSet/DaemonSet/Job/CronJob, поэтому имён может быть больше.
+# Новый формат (namespace/секрет, откуда ссылка, объект - через табуляцию) - с --output tsv.
+# Остальные аргументы передаются как есть, например:
+#   ./find_secrets_k8s.sh --output tsv --names-only
+#   ./find_secrets_k8s.sh --from-file dump.json
+
+exec python3 "$(dirname "$0")/find_secrets_k8s.py" --output legacy "$@"
@@ -1,8 +1,15 @@
 # Скрипт для обработки дублей
 # Создаёт линки на тикеты, которые указаны в комментариях(OPS-12345) и закрыты с resolution = Duplicate
 
+from concurrent.futures import ThreadPoolExecutor
 from jira import JIRA
+from jira.exceptions import JIRAError
+from datetime import datetime
+from run_state import FileBackend
+import run_metrics
 import oauthlib.oauth1
+import json
+import os
 import re
 
 JIRA_SERVER = "https://jira.osmp.ru"
@@ -24,30 +31,171 @@ JIRA_SERVER = "https://jira.osmp.ru"
 # }
 # jira = JIRA(server=JIRA_SERVER, oauth=oauth_dict)
 
-jira = JIRA(server=JIRA_SERVER, basic_auth=('username', 'password'))
-
 # Создаем JQL запрос (https://jira.osmp.ru/issues/?filter=78402)
-JQL = "project = OPS AND resolution = Duplicate AND comment ~ '*OPS-*' AND status changed to CLOSED during (-24h, now())  ORDER BY updated DESC"
+# Окно по updated добавляется в build_jql: от чекпоинта прошлого прогона или за BACKFILL_FROM..BACKFILL_TO
+JQL = "project = OPS AND resolution = Duplicate AND comment ~ '*OPS-*'"
+JQL_ORDER = "ORDER BY updated ASC, key ASC"
+
+# Чекпоинт: updated и ключ последнего обработанного тикета, следующий прогон начинает с него
+CHECKPOINT_FILE = os.getenv("CHECKPOINT_FILE", "jira_recursion_checkpoint.json")
+CHECKPOINT_JOB = "jira_recursion_cheker"
+# Окно для первого прогона, когда чекпоинта ещё нет
+DEFAULT_WINDOW = "-24h"
+# Дозагрузка за период (формат JQL, например 2024/01/01), чекпоинт при этом не меняется
+BACKFILL_FROM = os.getenv("BACKFILL_FROM")
+BACKFILL_TO = os.getenv("BACKFILL_TO")
+
+# Комментарии и линки приходят сразу в поиске, отдельные запросы на каждый тикет не нужны
+SEARCH_FIELDS = ["comment", "issuelinks", "updated"]
+PAGE_SIZE = 500
+MAIN_ISSUE_PATTERN = re.compile(r'SS-\d{5}')
+ISSUE_LINK_TYPE = 'relates'
+# Сколько линков создаётся параллельно
+LINK_WORKERS = 4
+
+
+# Все тикеты по JQL постранично (по умолчанию search_issues отдаёт только первые 50)
+def search_all(jira, jql):
+    issues = []
+    while True:
+        page = jira.search_issues(jql, startAt=len(issues), maxResults=PAGE_SIZE, fields=SEARCH_FIELDS)
+        issues.extend(page)
+        if not page or len(issues) >= page.total:
+            return issues
+
+
+# Окно поиска по updated. JQL сравнивает даты с точностью до минуты и в часовом поясе пользователя,
+# в нём же API отдаёт updated, поэтому берём минуту чекпоинта как есть, а тикеты той же минуты,
+# обработанные в прошлый раз, отсекаем локально (is_after_checkpoint)
+def build_jql(checkpoint):
+    if BACKFILL_FROM:
+        window = f'updated >= "{BACKFILL_FROM}"'
+        if BACKFILL_TO:
+            window += f' AND updated < "{BACKFILL_TO}"'
+    elif checkpoint:
+        window = f'updated >= "{parse_updated(checkpoint["updated"]).strftime("%Y/%m/%d %H:%M")}"'
+    else:
+        window = f'updated >= {DEFAULT_WINDOW}'
+    return f"{JQL} AND {window} {JQL_ORDER}"
+
+
+def parse_updated(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+# Порядок обработки: (updated, номер тикета), как в ORDER BY updated, key
+def position(updated, key):
+    return parse_updated(updated), int(key.rsplit("-", 1)[1])
+
+
+def is_after_checkpoint(issue, checkpoint):
+    if not checkpoint:
+        return True
+    return position(issue.fields.updated, issue.key) > position(checkpoint["updated"], checkpoint["key"])
+
 
-# Ищем тикеты по нашему запросу JQL
-issues = jira.search_issues(JQL)
+# Ключи тикетов, с которыми тикет уже связан (в любую сторону)
+def linked_keys(issue):
+    keys = set()
+    for link in issue.fields.issuelinks or []:
+        linked = getattr(link, "outwardIssue", None) or getattr(link, "inwardIssue", None)
+        if linked is not None:
+            keys.add(linked.key)
+    return keys
 
 
-def issue_link(issue, main_issue):
-    inwardIssue = jira.issue(issue)
-    outwardIssue = jira.issue(main_issue)
-    issueLinkType = 'relates'
-    jira.create_issue_link(issueLinkType, inwardIssue, outwardIssue)
+# Последний комментарий тикета. Поиск может отдать не все комментарии, тогда дочитываем их отдельно
+def last_comment(jira, issue):
+    comment_field = issue.fields.comment
+    comments = comment_field.comments
+    if getattr(comment_field, "total", len(comments)) > len(comments):
+        comments = jira.comments(issue)
+    return comments[-1].body if comments else ""
 
 
-for issue in issues:
-    # Ищем главный тикет из последнего комментария к которому линковать дубли
-    comments = jira.comments(issue)
-    last_comment = comments[-1].body
-    main_issue = re.findall(r'SS-\d{5}', last_comment)
-    main_issue = ''.join(main_issue)
+# Имя типа линка на сервере (по имени, outward или inward), определяется один раз за прогон.
+# Как и create_issue_link: если задано inward-название, тикеты в линке меняются местами
+def resolve_link_type(jira, link_type):
+    for lt in jira.issue_link_types():
+        if link_type in (lt.name, lt.outward):
+            return lt.name, False
+        if link_type == lt.inward:
+            return lt.name, True
+    return link_type, False
 
+
+# Вместо jira.create_issue_link: в библиотеке jira (3.x) issue_link_types() проверяет кэш через
+# hasattr(self, "self._cached_issue_link_types") - такого атрибута не бывает, поэтому create_issue_link
+# на каждый линк делает лишний GET issueLinkType. Тот же POST issueLink, что и в create_issue_link,
+# с уже найденным именем типа; приватные _session/_get_url используются только здесь.
+# Убрать, когда исправят в библиотеке.
+def issue_link(jira, link_type, issue_key, main_issue_key):
+    name, reverse = link_type
+    if reverse:
+        issue_key, main_issue_key = main_issue_key, issue_key
+    # Одна запись на линк: тикеты передаём ключами, без загрузки самих тикетов
+    data = {
+        "type": {"name": name},
+        "inwardIssue": {"key": issue_key},
+        "outwardIssue": {"key": main_issue_key},
+    }
+    jira._session.post(jira._get_url("issueLink"), data=json.dumps(data))
+
+
+def link_duplicate(jira, link_type, issue_key, main_issue_key):
     try:
-        issue_link(issue, main_issue)
-    except jira.exceptions.JIRAError as er:
-        print(f'Error{main_issue}: {er}')
+        issue_link(jira, link_type, issue_key, main_issue_key)
+        print(f'{issue_key} -> {main_issue_key}')
+        return True
+    except JIRAError as er:
+        print(f'Error{main_issue_key}: {er}')
+        return False
+
+
+def main():
+    jira = JIRA(server=JIRA_SERVER, basic_auth=('username', 'password'))
+    run_metrics.instrument_session(jira._session, "jira")
+
+    checkpoints = FileBackend(CHECKPOINT_FILE)
+    checkpoint = None if BACKFILL_FROM else checkpoints.load(CHECKPOINT_JOB)
+
+    # Ищем тикеты по нашему запросу JQL; найденные тикеты храним по ключу (в порядке updated, key)
+    jql = build_jql(checkpoint)
+    print(f'JQL: {jql}')
+    issues = {issue.key: issue for issue in search_all(jira, jql) if is_after_checkpoint(issue, checkpoint)}
+    print(f'Найдено дублей: {len(issues)}')
+
+    links = []
+    already_linked = 0
+    for key, issue in issues.items():
+        # Ищем главный тикет из последнего комментария к которому линковать дубли
+        main_issue = MAIN_ISSUE_PATTERN.search(last_comment(jira, issue))
+        if not main_issue:
+            print(f'{key}: в последнем комментарии нет ссылки на главный тикет, пропускаем')
+            continue
+        if main_issue.group() in linked_keys(issue):
+            already_linked += 1
+            continue
+        links.append((key, main_issue.group()))
+
+    link_type = resolve_link_type(jira, ISSUE_LINK_TYPE)
+    with ThreadPoolExecutor(max_workers=LINK_WORKERS) as pool:
+        results = list(pool.map(lambda link: link_duplicate(jira, link_type, *link), links))
+    failed = {key for (key, _), ok in zip(links, results) if not ok}
+
+    print(f'Создано линков: {len(links) - len(failed)}, уже связаны: {already_linked}, ошибок: {len(failed)}')
+
+    # Двигаем чекпоинт до первого тикета с ошибкой, чтобы следующий прогон повторил его
+    if BACKFILL_FROM:
+        return
+    for key, issue in issues.items():
+        if key in failed:
+            break
+        checkpoint = {"updated": issue.fields.updated, "key": key}
+    if checkpoint:
+        checkpoints.save(CHECKPOINT_JOB, checkpoint)
+
+
+if __name__ == "__main__":
+    with run_metrics.run("jira_recursion_cheker"):
+        main()
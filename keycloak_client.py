@@ -0,0 +1,186 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import run_metrics
+
+# Общий клиент Keycloak Admin API для keycloak_groups_roles.py и elk_keycloak_rolemappings.py:
+# одна keep-alive сессия, токен обновляется заранее, 429/5xx и сетевые ошибки повторяются с backoff.
+# POST не идемпотентен: если запрос дошёл, а ответ потерялся (5xx от прокси, таймаут чтения), повтор
+# создания вернёт 409. Поэтому POST повторяется только на 429 и когда соединение не установилось,
+# если вызывающий не пометил его idempotent=True (назначение ролей, partialImport с SKIP, токен).
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# За сколько секунд до истечения токена обновляем его
+TOKEN_REFRESH_MARGIN = 30
+
+
+# Запрос не ушёл на сервер: соединение отклонено или не установилось за timeout
+def not_sent(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+class KeycloakAdmin:
+    def __init__(self, url, token_realm, client_id, client_secret, username, password,
+                 pool_size=10, max_retries=5, backoff=0.5, max_backoff=10, timeout=30):
+        self.url = url.rstrip("/")
+        self.token_realm = token_realm
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.username = username
+        self.password = password
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        run_metrics.instrument_session(self.session, "keycloak")
+
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_at = 0
+        self._refresh_token = None
+        self._refresh_expires_at = 0
+
+    # === Токен ===
+    def _token_request(self, data):
+        data = {"client_id": self.client_id, **data}
+        if self.client_secret:
+            data["client_secret"] = self.client_secret
+        url = f"{self.url}/realms/{self.token_realm}/protocol/openid-connect/token"
+        response = self._send("POST", url, idempotent=True, data=data)
+        response.raise_for_status()
+        return response.json()
+
+    def _fetch_token(self):
+        now = time.time()
+        result = None
+        if self._refresh_token and now < self._refresh_expires_at - TOKEN_REFRESH_MARGIN:
+            try:
+                result = self._token_request({"grant_type": "refresh_token", "refresh_token": self._refresh_token})
+            except requests.exceptions.RequestException:
+                result = None
+        if result is None:
+            result = self._token_request({
+                "grant_type": "password",
+                "username": self.username,
+                "password": self.password,
+            })
+        self._access_token = result["access_token"]
+        self._expires_at = now + result.get("expires_in", 60)
+        self._refresh_token = result.get("refresh_token")
+        self._refresh_expires_at = now + result.get("refresh_expires_in", 0)
+
+    def token(self, force=False):
+        with self._lock:
+            if force or not self._access_token or time.time() >= self._expires_at - TOKEN_REFRESH_MARGIN:
+                self._fetch_token()
+            return self._access_token
+
+    # === Запросы ===
+    def _sleep_before_retry(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        else:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        # Full jitter, чтобы параллельные воркеры не ретраили синхронно
+        time.sleep(random.uniform(0, delay))
+
+    def _send(self, method, url, idempotent=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if idempotent is None:
+            idempotent = method != "POST"
+        retry_statuses = RETRY_STATUSES if idempotent else {429}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == self.max_retries or not (idempotent or not_sent(e)):
+                    raise
+                self._sleep_before_retry(attempt)
+                continue
+            if response.status_code in retry_statuses and attempt < self.max_retries:
+                self._sleep_before_retry(attempt, response)
+                continue
+            return response
+
+    def request(self, method, path, idempotent=None, **kwargs):
+        """path относительно /admin/realms, например '/test-realm/groups'."""
+        url = f"{self.url}/admin/realms{path}"
+        headers = kwargs.pop("headers", {})
+        response = self._send(method, url, idempotent,
+                              headers={**headers, "Authorization": f"Bearer {self.token()}"}, **kwargs)
+        if response.status_code == 401:
+            # Токен отозвали или он истёк раньше expires_in - берём новый и повторяем один раз
+            response = self._send(method, url, idempotent,
+                                  headers={**headers, "Authorization": f"Bearer {self.token(force=True)}"}, **kwargs)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def get_paged(self, path, page_size=100, **params):
+        """Читает список постранично через first/max и возвращает все элементы."""
+        items = []
+        first = 0
+        while True:
+            response = self.get(path, params={**params, "first": first, "max": page_size})
+            response.raise_for_status()
+            page = response.json()
+            items.extend(page)
+            if len(page) < page_size:
+                return items
+            first += page_size
+
+    def group_children(self, realm, group, page_size=100, brief=True):
+        """Подгруппы группы. Старые версии Keycloak (без subGroupCount) отдают их целиком в subGroups,
+        новые - только subGroupCount, тогда children читаются постранично."""
+        subgroups = group.get("subGroups") or []
+        if "subGroupCount" not in group or len(subgroups) >= group["subGroupCount"]:
+            return subgroups
+        return self.get_paged(f"/{realm}/groups/{group['id']}/children", page_size,
+                              briefRepresentation=str(brief).lower())
+
+    def walk_groups(self, realm, roots, page_size=100, brief=True, max_workers=8):
+        """Обход поддеревьев roots в ширину: children одного уровня запрашиваются параллельно.
+        Заполненные subGroups используются без запросов; иначе - GET /children (постранично) на каждую
+        группу с подгруппами, т.е. стоимость растёт с числом таких групп.
+        Возвращает (все группы, включая roots; [(группа, ошибка)] для групп, чьи подгруппы не прочитались)."""
+        groups, errors = [], []
+
+        def children(group):
+            try:
+                return self.group_children(realm, group, page_size, brief)
+            except Exception as e:
+                errors.append((group, e))
+                return []
+
+        level = list(roots)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while level:
+                groups.extend(level)
+                level = [child for result in pool.map(children, level) for child in result]
+        return groups, errors
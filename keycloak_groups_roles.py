@@ -1,47 +1,48 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
 import json
 import urllib3
 import os
 
+from keycloak_client import KeycloakAdmin
+from run_state import RunState
+import run_metrics
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 KEYCLOAK_URL = os.getenv("KEYCLOAK_URL")
 MASTER_REALM = os.getenv("MASTER_REALM")
 ADMIN_USER = os.getenv("ADMIN_USER")
-ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD") 
+ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")  
+CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
 NEW_REALM = os.getenv("NEW_REALM")
-GROUPS_TO_CREATE = os.getenv("GROUPS_TO_CREATE").split()
-SUBGROUPS = os.getenv("SUBGROUPS").split()
-ROLE_SUFFIX = os.getenv("ROLE_SUFFIX") # роль будет {group_name}{subgroup}{suffix}
-
-
-# Получение токена администратора
-def get_admin_token():
-    token_url = f"{KEYCLOAK_URL}/realms/{MASTER_REALM}/protocol/openid-connect/token"
-    data = {
-        "username": ADMIN_USER,
-        "password": ADMIN_PASSWORD,
-        "grant_type": "password",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET
-    }
-    response = requests.post(token_url, data=data, verify=False)
-    response.raise_for_status()
-    return response.json()["access_token"]
+GROUPS_TO_CREATE = os.getenv("GROUPS_TO_CREATE", "").split()
+SUBGROUPS = os.getenv("SUBGROUPS", "").split()
+ROLE_SUFFIX = os.getenv("ROLE_SUFFIX", "") # роль будет {group_name}{subgroup}{suffix}
 
+PAGE_SIZE = 100
+# Сколько поддеревьев {group}/{subgroup} создаётся параллельно (не перегружаем admin API)
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+# api            - каждая группа, роль и назначение роли отдельным запросом admin API;
+# partial_import - желаемый фрагмент реалма (роли, группы с subGroups и realmRoles) собирается в памяти
+#                  и применяется запросами partialImport с ifResourceExists=SKIP
+PROVISION_MODE = os.getenv("PROVISION_MODE", "api")
+# Сколько ролей / групп в одном запросе partialImport
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
 
-# Создание нового реалма
-def create_realm(token):
-    url = f"{KEYCLOAK_URL}/admin/realms/{NEW_REALM}"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
 
+# Клиент Keycloak Admin API (токен администратора берётся и обновляется внутри)
+def get_admin_client():
+    return KeycloakAdmin(KEYCLOAK_URL, MASTER_REALM, CLIENT_ID, CLIENT_SECRET, ADMIN_USER, ADMIN_PASSWORD,
+                         pool_size=MAX_WORKERS)
+
+
+# Создание нового реалма
+def create_realm(kc):
     # Проверяем, существует ли реалм
-    response = requests.get(url, headers=headers, verify=False)
+    response = kc.get(f"/{NEW_REALM}")
 
     if response.status_code == 200:
         print(f"Реалм '{NEW_REALM}' уже существует.")
@@ -51,24 +52,22 @@ def create_realm(token):
         response.raise_for_status()
 
     # Реалм не найден — создаём его
-    url_create = f"{KEYCLOAK_URL}/admin/realms"
     payload = {
         "realm": NEW_REALM,
         "enabled": True
     }
-    create_response = requests.post(url_create, headers={**headers, "Content-Type": "application/json"},
-                                    json=payload, verify=False)
+    create_response = kc.post("", json=payload)
+    if create_response.status_code == 409:
+        # Реалм создан параллельно или предыдущей попыткой, ответ на которую потерялся
+        print(f"Реалм '{NEW_REALM}' уже существует.")
+        return
     create_response.raise_for_status()
     print(f"Реалм '{NEW_REALM}' успешно создан.")
 
 
 # Получение ID реалма по имени
-def get_realm_id(token, realm_name):
-    url = f"{KEYCLOAK_URL}/admin/realms"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    response = requests.get(url, headers=headers, verify=False)
+def get_realm_id(kc, realm_name):
+    response = kc.get("")
     response.raise_for_status()
     realms = response.json()
     for r in realms:
@@ -77,14 +76,43 @@ def get_realm_id(token, realm_name):
     raise Exception(f"Realm {realm_name} не найден")
 
 
-# Создание группы
-def create_group(token, realm, parent_group_id, group_name, parent_path=""):
-    url = f"{KEYCLOAK_URL}/admin/realms/{realm}/groups"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
+# Получение списка групп (постранично, вместе с назначенными ролями)
+def get_groups(kc, realm, parent_group_id=None):
+    path = f"/{realm}/groups"
+    if parent_group_id:
+        path += f"/{parent_group_id}/children"
+    return kc.get_paged(path, PAGE_SIZE, briefRepresentation="false")
+
+
+# Индекс дерева групп: path -> {"id", "realmRoles"}, загружается один раз за прогон.
+# Обходим только поддеревья групп из GROUPS_TO_CREATE, остальные корневые группы нам не нужны.
+# Корневая группа ищется через ?search= с exact=true: Keycloak отдаёт её вместе с поддеревом subGroups,
+# тогда индекс строится одним GET на корень. Если версия Keycloak отдаёт только subGroupCount,
+# walk_groups дочитывает подгруппы - по GET на каждую группу с подгруппами (для 20 тенантов x 2 суффикса
+# под /elk это ~21 GET, для 1000 тенантов ~1001), см. профиль бенчмарка --group-search flat.
+def load_group_index(kc, realm, root_names):
+    roots = [g for name in root_names
+             for g in kc.get_paged(f"/{realm}/groups", PAGE_SIZE, search=name, exact="true",
+                                   briefRepresentation="false")
+             if g["name"] == name]
+    groups, errors = kc.walk_groups(realm, roots, PAGE_SIZE, brief=False, max_workers=MAX_WORKERS)
+    if errors:
+        # По неполному индексу нельзя решать, какие группы создавать
+        group, error = errors[0]
+        raise Exception(f"Не удалось получить подгруппы '{group.get('path')}': {error}")
+    return {g["path"]: {"id": g["id"], "realmRoles": set(g.get("realmRoles", []))} for g in groups}
+
+
+# Создание группы, если её нет в индексе. Возвращает запись индекса {"id", "realmRoles"}.
+# out - куда писать сообщения: из потоков provision_api они собираются и печатаются по поддеревьям
+def ensure_group(kc, realm, group_index, parent_path, group_name, out=print):
+    path = f"{parent_path}/{group_name}"
+    if path in group_index:
+        out(f"Группа '{group_name}' уже существует в '{parent_path.lstrip('/')}'.")
+        return group_index[path]
+
+    url = f"/{realm}/groups"
+    parent_group_id = group_index[parent_path]["id"] if parent_path else None
     if parent_group_id:
         url += f"/{parent_group_id}/children"
 
@@ -92,110 +120,279 @@ def create_group(token, realm, parent_group_id, group_name, parent_path=""):
         "name": group_name
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload), verify=False)
+    response = kc.post(url, headers={"Content-Type": "application/json"}, data=json.dumps(payload))
     if response.status_code == 409:
-        print(f"Группа '{group_name}' уже существует в '{parent_path}'.")
-        # Получаем существующую группу, чтобы получить её ID
-        groups = get_groups(token, realm, parent_group_id)
-        for g in groups:
+        # Группу успел создать кто-то другой после загрузки индекса
+        out(f"Группа '{group_name}' уже существует в '{parent_path.lstrip('/')}'.")
+        for g in get_groups(kc, realm, parent_group_id):
             if g["name"] == group_name:
-                return g["id"]
-    else:
-        response.raise_for_status()
-        print(f"Создана группа '{group_name}' в '{parent_path}'.")
-    
+                group_index[path] = {"id": g["id"], "realmRoles": set(g.get("realmRoles", []))}
+                return group_index[path]
+        raise Exception(f"Группа '{path}' не найдена")
+
+    response.raise_for_status()
+    out(f"Создана группа '{group_name}' в '{parent_path.lstrip('/')}'.")
+
     location = response.headers.get("Location")
-    group_id = location.split("/")[-1]
-    return group_id
+    group_index[path] = {"id": location.split("/")[-1], "realmRoles": set()}
+    return group_index[path]
 
 
-# Получение списка групп
-def get_groups(token, realm, parent_group_id=None):
-    url = f"{KEYCLOAK_URL}/admin/realms/{realm}/groups"
-    if parent_group_id:
-        url += f"/{parent_group_id}/children"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    response = requests.get(url, headers=headers, verify=False)
+# Индекс ролей реалма: имя -> представление роли (с id), строится один раз за прогон
+def load_role_index(kc, realm):
+    roles = kc.get_paged(f"/{realm}/roles", PAGE_SIZE, briefRepresentation="true")
+    return {r["name"]: r for r in roles}
+
+
+# Получение одной роли по имени (нужен её id после создания)
+def get_role(kc, realm, role_name):
+    response = kc.get(f"/{realm}/roles/{role_name}")
     response.raise_for_status()
     return response.json()
 
 
-# Создание роли
-def create_role(token, realm, role_name):
-    url = f"{KEYCLOAK_URL}/admin/realms/{realm}/roles"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+# Создание роли (если её нет в индексе)
+def create_role(kc, realm, role_name, role_index, out=print):
+    if role_name in role_index:
+        out(f"Роль '{role_name}' уже существует.")
+        return
+
     payload = {
         "name": role_name
     }
-    response = requests.post(url, headers=headers, data=json.dumps(payload), verify=False)
+    response = kc.post(f"/{realm}/roles", headers={"Content-Type": "application/json"}, data=json.dumps(payload))
     if response.status_code == 409:
-        print(f"Роль '{role_name}' уже существует.")
+        out(f"Роль '{role_name}' уже существует.")
     else:
         response.raise_for_status()
-        print(f"Создана роль '{role_name}'.")
+        out(f"Создана роль '{role_name}'.")
+    # POST не возвращает id роли, дочитываем её один раз и кладём в индекс
+    role_index[role_name] = get_role(kc, realm, role_name)
 
 
 # Назначение роли на группу
-def assign_role_to_group(token, realm, group_id, role_name):
-    url = f"{KEYCLOAK_URL}/admin/realms/{realm}/groups/{group_id}/role-mappings/realm"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+def assign_role_to_group(kc, realm, group, role_name, role_index, out=print):
+    if role_name in group["realmRoles"]:
+        out(f"Роль '{role_name}' уже назначена на группу.")
+        return
 
-    # Получаем ID роли
-    roles_url = f"{KEYCLOAK_URL}/admin/realms/{realm}/roles"
-    response = requests.get(roles_url, headers=headers, verify=False)
-    response.raise_for_status()
-    roles = response.json()
-    role = next((r for r in roles if r["name"] == role_name), None)
+    role = role_index.get(role_name)
     if not role:
         raise Exception(f"Роль '{role_name}' не найдена")
 
     payload = [{"id": role["id"], "name": role["name"]}]
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload), verify=False)
+    # Повторное назначение той же роли ничего не меняет, поэтому POST можно повторять
+    response = kc.post(f"/{realm}/groups/{group['id']}/role-mappings/realm", idempotent=True,
+                       headers={"Content-Type": "application/json"}, data=json.dumps(payload))
     response.raise_for_status()
-    print(f"Роль '{role_name}' назначена на группу.")
+    group["realmRoles"].add(role_name)
+    out(f"Роль '{role_name}' назначена на группу.")
+
+
+# Поддерево {group_name}/{subgroup}: подгруппа, группы ролей, роли и их назначение.
+# Внутри поддерева порядок строгий (роль создаётся до назначения), разные поддеревья независимы.
+# Выполняется в потоке, поэтому сообщения не печатает, а возвращает: (сообщения, ошибка или None)
+def provision_subgroup(kc, group_index, role_index, group_name, subgroup, role_suffixes):
+    lines = []
+    try:
+        # Создаём подгруппу
+        ensure_group(kc, NEW_REALM, group_index, f"/{group_name}", subgroup, lines.append)
+        for suffix in role_suffixes:
+            # Формируем общее имя с префиксом group_name
+            role_key = f"{group_name}{subgroup}{suffix}"
+
+            # Создаём подгруппу с именем {group_name}{subgroup}{suffix}
+            role_group = ensure_group(kc, NEW_REALM, group_index, f"/{group_name}/{subgroup}", role_key, lines.append)
+
+            # Создаём роль с тем же именем
+            create_role(kc, NEW_REALM, role_key, role_index, lines.append)
+
+            # Назначаем роль на группу
+            assign_role_to_group(kc, NEW_REALM, role_group, role_key, role_index, lines.append)
+    except Exception as e:
+        return lines, e
+    return lines, None
+
+
+# Поддеревья через admin API. group_index можно передать, если дерево уже загружено.
+# Возвращает (индекс групп, {(group_name, subgroup): ошибка})
+def provision_api(kc, pending, role_suffixes, group_index=None):
+    # Все роли реалма читаем один раз, дальше поиск по имени без запросов
+    role_index = load_role_index(kc, NEW_REALM)
+
+    # Дерево наших групп читаем один раз, дальше создаём только недостающие узлы
+    root_names = list(dict.fromkeys(group_name for group_name, _ in pending))
+    if group_index is None:
+        group_index = load_group_index(kc, NEW_REALM, root_names)
+
+    # Создаём основные группы, от них зависят все поддеревья
+    for group_name in root_names:
+        ensure_group(kc, NEW_REALM, group_index, "", group_name)
+
+    # Поддеревья {group}/{subgroup} независимы, создаём их параллельно.
+    # Сообщения печатает основной поток, целиком по поддереву, по мере завершения
+    errors = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {
+            pool.submit(provision_subgroup, kc, group_index, role_index, group_name, subgroup, role_suffixes):
+                (group_name, subgroup)
+            for group_name, subgroup in pending
+        }
+        for future in as_completed(futures):
+            lines, error = future.result()
+            if lines:
+                print("\n".join(lines))
+            if error is not None:
+                errors[futures[future]] = error
+    return group_index, errors
+
+
+# === Режим partial_import ===
+# Keycloak пропускает (SKIP) роль с существующим именем и корневую группу с существующим именем -
+# вместе со всем её поддеревом. Поэтому через partialImport создаются роли и новые корневые группы
+# целиком, а поддеревья под уже существующими корневыми группами - через admin API (provision_api).
+def desired_subtree(group_name, subgroup, role_suffixes):
+    return {
+        "name": subgroup,
+        "subGroups": [
+            {"name": f"{group_name}{subgroup}{suffix}", "realmRoles": [f"{group_name}{subgroup}{suffix}"]}
+            for suffix in role_suffixes
+        ]
+    }
 
 
-def main():
-    token = get_admin_token()
+def group_count(group):
+    return 1 + sum(group_count(child) for child in group.get("subGroups", []))
 
-    create_realm(token)
 
+def partial_import(kc, realm, fragment):
+    """Один запрос partialImport, возвращает результаты (action, resourceType, resourceName)."""
+    # С SKIP повтор пропускает уже созданное, поэтому POST можно повторять
+    response = kc.post(f"/{realm}/partialImport", idempotent=True, json={"ifResourceExists": "SKIP", **fragment})
+    response.raise_for_status()
+    return response.json().get("results", [])
+
+
+# Партии по IMPORT_CHUNK_SIZE: корневая группа с поддеревом не делится (её вторая часть была бы пропущена)
+def import_batches(items, size_of):
+    batch, size = [], 0
+    for item in items:
+        if batch and size + size_of(item) > IMPORT_CHUNK_SIZE:
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += size_of(item)
+    if batch:
+        yield batch
+
+
+def provision_partial_import(kc, pending, role_suffixes):
+    counts = Counter()
+    errors = {}
+
+    # 1. Роли (раньше групп: группы ссылаются на них в realmRoles)
+    roles = [{"name": f"{group_name}{subgroup}{suffix}"} for group_name, subgroup in pending for suffix in role_suffixes]
+    for batch in import_batches(roles, lambda role: 1):
+        try:
+            results = partial_import(kc, NEW_REALM, {"roles": {"realm": batch}})
+        except Exception as e:
+            # Без ролей группы создавать нельзя, весь прогон неудачный
+            return {}, {key: e for key in pending}
+        counts.update((r["resourceType"], r["action"]) for r in results)
+
+    # 2. Новые корневые группы целиком, с подгруппами и назначенными ролями
+    root_names = list(dict.fromkeys(group_name for group_name, _ in pending))
+    group_index = load_group_index(kc, NEW_REALM, root_names)
+    trees = [
+        {"name": root, "subGroups": [desired_subtree(root, subgroup, role_suffixes)
+                                     for group_name, subgroup in pending if group_name == root]}
+        for root in root_names if f"/{root}" not in group_index
+    ]
+    skipped_roots = set()
+    for batch in import_batches(trees, group_count):
+        try:
+            results = partial_import(kc, NEW_REALM, {"groups": batch})
+        except Exception as e:
+            for tree in batch:
+                errors.update({(tree["name"], subgroup["name"]): e for subgroup in tree["subGroups"]})
+            continue
+        counts.update((r["resourceType"], r["action"]) for r in results)
+        skipped_roots.update(r["resourceName"] for r in results
+                             if r["resourceType"] == "GROUP" and r["action"] == "SKIPPED")
+        # id групп не нужны дальше: индекс используется только как список путей (elk_kk_reconcile.py)
+        for tree in batch:
+            if tree["name"] in skipped_roots:
+                continue
+            group_index[f"/{tree['name']}"] = {"id": None, "realmRoles": set()}
+            for subgroup in tree["subGroups"]:
+                group_index[f"/{tree['name']}/{subgroup['name']}"] = {"id": None, "realmRoles": set()}
+                for role_group in subgroup["subGroups"]:
+                    group_index[f"/{tree['name']}/{subgroup['name']}/{role_group['name']}"] = {
+                        "id": None, "realmRoles": set(role_group["realmRoles"])}
+
+    print(f"partialImport: ролей добавлено {counts[('REALM_ROLE', 'ADDED')]}, "
+          f"пропущено {counts[('REALM_ROLE', 'SKIPPED')]}; корневых групп добавлено {counts[('GROUP', 'ADDED')]}, "
+          f"пропущено {counts[('GROUP', 'SKIPPED')]}.")
+
+    # 3. Поддеревья под существующими (или созданными кем-то параллельно) корневыми группами
+    imported_roots = {tree["name"] for tree in trees} - skipped_roots
+    rest = [(group_name, subgroup) for group_name, subgroup in pending
+            if group_name not in imported_roots and (group_name, subgroup) not in errors]
+    if rest:
+        print(f"Поддеревьев под существующими группами: {len(rest)}, создаём через admin API.")
+        if skipped_roots:
+            group_index.update(load_group_index(kc, NEW_REALM, list(skipped_roots)))
+        _, api_errors = provision_api(kc, rest, role_suffixes, group_index)
+        errors.update(api_errors)
+    return group_index, errors
+
+
+# Возвращает индекс групп (path -> {"id", "realmRoles"}) по загруженным поддеревьям
+# или None, если прогон пропущен. kc передаёт единый процесс (elk_kk_reconcile.py).
+def main(kc=None):
     # Парсим ROLE_SUFFIX как список (чтобы можно было передать несколько ролей через запятую)
     role_suffixes = [suffix.strip() for suffix in ROLE_SUFFIX.split(",")]
 
-    for group_name in GROUPS_TO_CREATE:
-        # Создаём основную группу
-        group_id = create_group(token, NEW_REALM, None, group_name)
-        for subgroup in SUBGROUPS:
-            # Создаём подгруппу
-            subgroup_id = create_group(token, NEW_REALM, group_id, subgroup, parent_path=group_name)
-            for suffix in role_suffixes:
-                # Формируем общее имя с префиксом group_name
-                role_key = f"{group_name}{subgroup}{suffix}"
-
-                # Создаём подгруппу с именем {group_name}{subgroup}{suffix}
-                role_group_id = create_group(
-                    token,
-                    NEW_REALM,
-                    subgroup_id,
-                    role_key,
-                    parent_path=f"{group_name}/{subgroup}"
-                )
-
-                # Создаём роль с тем же именем
-                create_role(token, NEW_REALM, role_key)
-
-                # Назначаем роль на группу
-                assign_role_to_group(token, NEW_REALM, role_group_id, role_key)
+    # Инкрементальный режим: создаём только поддеревья, которых не было в прошлом успешном прогоне
+    # (раз в FULL_VERIFY_HOURS сверяем все)
+    state = RunState("keycloak_groups_roles")
+    full_verify = state.full_verify_due()
+    specs = {
+        f"{group_name}/{subgroup}": {"realm": NEW_REALM, "suffixes": role_suffixes}
+        for group_name in GROUPS_TO_CREATE
+        for subgroup in SUBGROUPS
+    }
+    for key in state.removed(specs):
+        state.forget(key)
+    pending = [tuple(key.split("/", 1)) for key in state.changed(specs)]
+    if not pending:
+        print(f"Изменений с прошлого прогона нет ({len(specs)} поддеревьев), пропускаем.")
+        state.save()
+        return None
+
+    kc = kc or get_admin_client()
+
+    create_realm(kc)
+
+    if PROVISION_MODE == "partial_import":
+        group_index, errors = provision_partial_import(kc, pending, role_suffixes)
+    else:
+        group_index, errors = provision_api(kc, pending, role_suffixes)
+
+    for group_name, subgroup in pending:
+        key = f"{group_name}/{subgroup}"
+        if (group_name, subgroup) in errors:
+            print(f"[ERROR] Ошибка при создании '{key}': {errors[(group_name, subgroup)]}")
+        else:
+            state.mark_applied(key, specs[key])
+    state.save(full_verify=full_verify and not errors)
+    if errors:
+        print(f"Не удалось создать {len(errors)} из {len(pending)} поддеревьев.")
+        exit(1)
+    return group_index
+
 
 if __name__ == "__main__":
-    main()
+    with run_metrics.run("keycloak_groups_roles"):
+        main()
@@ -0,0 +1,215 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+import requests
+
+# Метрики исходящих HTTP-запросов для всех задач синхронизации.
+# Клиенты (requests.Session, Elasticsearch) оборачиваются при создании: каждый запрос
+# записывается как (API, метод, шаблон пути, статус, задержка). В конце прогона метрики
+# выгружаются в формате Prometheus и печатается JSON-сводка по API:
+#   METRICS_TEXTFILE_DIR - каталог textfile-коллектора node-exporter (<задача>.prom)
+#   METRICS_PUSHGATEWAY  - адрес Pushgateway (PUT /metrics/job/<задача>)
+#   METRICS_JSON_FILE    - куда дополнительно записать JSON-сводку
+
+METRICS_TEXTFILE_DIR = os.getenv("METRICS_TEXTFILE_DIR")
+METRICS_PUSHGATEWAY = os.getenv("METRICS_PUSHGATEWAY")
+METRICS_JSON_FILE = os.getenv("METRICS_JSON_FILE")
+
+# Границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Сегменты пути, которые оставляем как есть; остальные (имена, id) заменяются на {}
+# чтобы число серий не росло вместе с числом тенантов и групп
+STATIC_SEGMENTS = {
+    "admin", "realms", "groups", "children", "roles", "role-mappings", "realm", "group-by-path",
+    "policy", "aliases", "indices", "role", "role_mapping", "stats",
+    "protocol", "openid-connect", "token", "partialImport", "users",
+    "api", "saved_objects", "rest", "2", "issueLink", "issueLinkType", "search", "serverInfo", "field",
+    "v1", "namespaces", "configmaps",
+}
+
+
+def endpoint_template(path):
+    segments = []
+    for segment in path.split("?", 1)[0].strip("/").split("/"):
+        if not segment:
+            continue
+        if segment.startswith("_") or segment in STATIC_SEGMENTS:
+            segments.append(segment)
+        elif not segments or segments[-1] != "{}":
+            segments.append("{}")
+        if segment == "group-by-path":
+            # Всё после group-by-path - путь группы
+            segments.append("{}")
+            break
+    return "/" + "/".join(segments)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}   # (API, метод, шаблон, статус) -> число
+        self.latency = {}    # API -> {"buckets": [...], "sum": секунды, "count": число}
+        self.runs = {}       # задача -> {"duration", "success", "finished_at"}
+
+    def record(self, family, method, path, status, latency):
+        key = (family, method, endpoint_template(path), str(status))
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latency.setdefault(family, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += latency
+            histogram["count"] += 1
+
+    # === Выгрузка ===
+    def summary(self):
+        families = {}
+        with self.lock:
+            for (family, _, _, status), count in self.requests.items():
+                entry = families.setdefault(family, {"requests": 0, "errors": 0})
+                entry["requests"] += count
+                if not status.isdigit() or int(status) >= 400:
+                    entry["errors"] += count
+            for family, histogram in self.latency.items():
+                entry = families.setdefault(family, {"requests": 0, "errors": 0})
+                entry["latency_sum_s"] = round(histogram["sum"], 3)
+                entry["latency_p95_le_s"] = bucket_quantile(histogram, 0.95)
+            return {"runs": dict(self.runs), "apis": families}
+
+    def prometheus(self):
+        lines = [
+            "# HELP sync_http_requests_total Outbound HTTP requests of the sync jobs.",
+            "# TYPE sync_http_requests_total counter",
+        ]
+        with self.lock:
+            for (family, method, endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'sync_http_requests_total{{api="{family}",method="{method}",'
+                             f'endpoint="{endpoint}",status="{status}"}} {count}')
+            lines += [
+                "# HELP sync_http_request_duration_seconds Outbound HTTP request latency.",
+                "# TYPE sync_http_request_duration_seconds histogram",
+            ]
+            for family, histogram in sorted(self.latency.items()):
+                for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f'sync_http_request_duration_seconds_bucket{{api="{family}",le="{bound}"}} {count}')
+                lines.append(f'sync_http_request_duration_seconds_bucket{{api="{family}",le="+Inf"}} '
+                             f'{histogram["count"]}')
+                lines.append(f'sync_http_request_duration_seconds_sum{{api="{family}"}} {histogram["sum"]:.6f}')
+                lines.append(f'sync_http_request_duration_seconds_count{{api="{family}"}} {histogram["count"]}')
+            lines += [
+                "# HELP sync_run_duration_seconds Duration of the last run.",
+                "# TYPE sync_run_duration_seconds gauge",
+            ]
+            lines += [f'sync_run_duration_seconds{{job="{job}"}} {run["duration"]:.3f}'
+                      for job, run in sorted(self.runs.items())]
+            lines += [
+                "# HELP sync_run_success Whether the last run finished without errors.",
+                "# TYPE sync_run_success gauge",
+            ]
+            lines += [f'sync_run_success{{job="{job}"}} {int(run["success"])}' for job, run in sorted(self.runs.items())]
+            lines += [
+                "# HELP sync_run_finished_timestamp_seconds When the last run finished.",
+                "# TYPE sync_run_finished_timestamp_seconds gauge",
+            ]
+            lines += [f'sync_run_finished_timestamp_seconds{{job="{job}"}} {run["finished_at"]}'
+                      for job, run in sorted(self.runs.items())]
+        return "\n".join(lines) + "\n"
+
+    def export(self, job):
+        text = self.prometheus()
+        if METRICS_TEXTFILE_DIR:
+            # node-exporter не должен прочитать недописанный файл
+            path = os.path.join(METRICS_TEXTFILE_DIR, f"{job}.prom")
+            with open(f"{path}.tmp", 'w') as file:
+                file.write(text)
+            os.replace(f"{path}.tmp", path)
+        if METRICS_PUSHGATEWAY:
+            try:
+                requests.put(f"{METRICS_PUSHGATEWAY.rstrip('/')}/metrics/job/{job}", data=text, timeout=10)
+            except requests.exceptions.RequestException as e:
+                print(f"Failed to push metrics: {e}")
+
+        summary = self.summary()
+        if METRICS_JSON_FILE:
+            with open(METRICS_JSON_FILE, 'w') as file:
+                json.dump(summary, file, indent=2)
+        print(f"metrics {json.dumps(summary, sort_keys=True)}")
+
+
+def bucket_quantile(histogram, quantile):
+    """Верхняя граница корзины, в которую попадает квантиль (как оценка сверху)."""
+    if not histogram["count"]:
+        return 0.0
+    target = quantile * histogram["count"]
+    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        if count >= target:
+            return bound
+    return None
+
+
+METRICS = Metrics()
+
+
+# === Обёртки клиентов ===
+def instrument_session(session, family):
+    """Все запросы через session (в т.ч. получение токена) попадают в метрики под именем family."""
+    send = session.send
+
+    def instrumented_send(request, **kwargs):
+        path = urllib.parse.urlsplit(request.url).path
+        started = time.monotonic()
+        try:
+            response = send(request, **kwargs)
+        except Exception as e:
+            METRICS.record(family, request.method, path, type(e).__name__, time.monotonic() - started)
+            raise
+        METRICS.record(family, request.method, path, response.status_code, time.monotonic() - started)
+        return response
+
+    session.send = instrumented_send
+    return session
+
+
+def instrument_es(es, family="es"):
+    """Оборачивает транспорт клиента Elasticsearch (общий для es.ilm, es.indices, es.security ...)."""
+    transport = es.transport
+    perform_request = transport.perform_request
+
+    def instrumented_perform_request(method, target, **kwargs):
+        started = time.monotonic()
+        try:
+            response = perform_request(method, target, **kwargs)
+        except Exception as e:
+            status = getattr(getattr(e, "meta", None), "status", None) or type(e).__name__
+            METRICS.record(family, method, target, status, time.monotonic() - started)
+            raise
+        METRICS.record(family, method, target, response.meta.status, time.monotonic() - started)
+        return response
+
+    transport.perform_request = instrumented_perform_request
+    return es
+
+
+# === Прогон задачи ===
+@contextlib.contextmanager
+def run(job):
+    """Оборачивает прогон задачи: в конце (в т.ч. после exit(1)) выгружает метрики."""
+    started = time.monotonic()
+    success = False
+    try:
+        yield
+        success = True
+    except SystemExit as e:
+        success = not e.code
+        raise
+    finally:
+        with METRICS.lock:
+            METRICS.runs[job] = {"duration": time.monotonic() - started, "success": success,
+                                 "finished_at": int(time.time())}
+        METRICS.export(job)
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+import run_metrics
+
+# Состояние между прогонами CronJob: отпечаток желаемого состояния каждого элемента (тенант,
+# поддерево групп, role_mapping) и время последней полной сверки.
+# Хранится в файле (STATE_FILE) или в ключе ConfigMap (STATE_CONFIGMAP), ключ = имя задачи.
+# Если ни то ни другое не задано, инкрементальный режим выключен и каждый прогон полный
+# (кроме контроллера, который держит состояние в памяти).
+
+STATE_FILE = os.getenv("STATE_FILE")
+STATE_CONFIGMAP = os.getenv("STATE_CONFIGMAP")
+# Раз в сколько часов делаем полную сверку, даже если входные данные не менялись
+FULL_VERIFY_HOURS = float(os.getenv("FULL_VERIFY_HOURS", "24"))
+
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+KUBERNETES_API = "https://kubernetes.default.svc"
+
+
+def fingerprint(spec):
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+# === Хранилища ===
+class FileBackend:
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, job):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file).get(job)
+        except FileNotFoundError:
+            return None
+
+    def save(self, job, data):
+        try:
+            with open(self.path, 'r') as file:
+                content = json.load(file)
+        except FileNotFoundError:
+            content = {}
+        content[job] = data
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(content, file)
+        os.replace(tmp_path, self.path)
+
+
+class ConfigMapBackend:
+    def __init__(self, name):
+        with open(f"{SERVICE_ACCOUNT_DIR}/namespace") as file:
+            namespace = file.read().strip()
+        with open(f"{SERVICE_ACCOUNT_DIR}/token") as file:
+            token = file.read().strip()
+        self.url = f"{KUBERNETES_API}/api/v1/namespaces/{namespace}/configmaps"
+        self.name = name
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.session.verify = f"{SERVICE_ACCOUNT_DIR}/ca.crt"
+        run_metrics.instrument_session(self.session, "kubernetes")
+
+    def load(self, job):
+        response = self.session.get(f"{self.url}/{self.name}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        raw = (response.json().get("data") or {}).get(job)
+        return json.loads(raw) if raw else None
+
+    def save(self, job, data):
+        # merge patch трогает только ключ своей задачи, остальные задачи пишут свои ключи
+        patch = {"data": {job: json.dumps(data)}}
+        response = self.session.patch(f"{self.url}/{self.name}", json=patch,
+                                      headers={"Content-Type": "application/merge-patch+json"})
+        if response.status_code == 404:
+            response = self.session.post(self.url, json={"metadata": {"name": self.name}, **patch})
+        response.raise_for_status()
+
+
+class MemoryBackend:
+    """Состояние в памяти процесса: для контроллера, если STATE_CONFIGMAP/STATE_FILE не заданы."""
+    def __init__(self):
+        self.jobs = {}
+
+    def load(self, job):
+        data = self.jobs.get(job)
+        return json.loads(json.dumps(data)) if data else None
+
+    def save(self, job, data):
+        self.jobs[job] = json.loads(json.dumps(data))
+
+
+# Долгоживущий процесс (elk_kk_controller.py) подставляет сюда MemoryBackend
+memory_backend = None
+
+
+class RunState:
+    def __init__(self, job):
+        self.job = job
+        if STATE_CONFIGMAP:
+            self.backend = ConfigMapBackend(STATE_CONFIGMAP)
+        elif STATE_FILE:
+            self.backend = FileBackend(STATE_FILE)
+        elif memory_backend is not None:
+            self.backend = memory_backend
+        else:
+            self.backend = None
+        loaded = self.backend.load(job) if self.backend else None
+        self.data = loaded or {"last_full_verify": 0, "items": {}}
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def full_verify_due(self):
+        return not self.enabled or time.time() - self.data["last_full_verify"] >= FULL_VERIFY_HOURS * 3600
+
+    def changed(self, specs):
+        """Ключи из specs ({ключ: желаемое состояние}), которые надо применить в этом прогоне."""
+        if self.full_verify_due():
+            return list(specs)
+        items = self.data["items"]
+        return [key for key, spec in specs.items() if items.get(key, {}).get("hash") != fingerprint(spec)]
+
+    def removed(self, specs):
+        """Ключи, которые применялись раньше, но больше не нужны."""
+        return [key for key in self.data["items"] if key not in specs]
+
+    def mark_applied(self, key, spec):
+        self.data["items"][key] = {"hash": fingerprint(spec), "applied_at": int(time.time())}
+
+    def forget(self, key):
+        self.data["items"].pop(key, None)
+
+    def save(self, full_verify=False):
+        if not self.enabled:
+            return
+        if full_verify:
+            self.data["last_full_verify"] = int(time.time())
+        self.backend.save(self.job, self.data)
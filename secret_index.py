@@ -0,0 +1,272 @@
+# Индекс использования секретов в Kubernetes: namespace/секрет -> объекты, которые его используют,
+# и обратно. Хранится в файле, запросы (кто использует секрет, что использует объект,
+# неиспользуемые секреты) отвечают по индексу без обращения к кластеру.
+#
+# Обновление инкрементальное: для каждого вида ресурсов запоминается resourceVersion списка,
+# и следующий refresh читает только события watch после него (ADDED/MODIFIED/DELETED).
+# Если история в etcd уже сжата (410 Gone), вид перечитывается целиком, но ссылки заново
+# извлекаются только из объектов с изменившимся resourceVersion.
+#
+#   python3 secret_index.py refresh                 # первый раз - полное чтение кластера
+#   python3 secret_index.py who-uses kibana/unified-secrets
+#   python3 secret_index.py uses Deployment/kibana/elk-kk-controller
+#   python3 secret_index.py unused
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import subprocess
+import sys
+import urllib.parse
+
+from find_secrets_k8s import API_PATHS, CHUNK_SIZE, KINDS, iter_dump_objects, kubectl_raw, list_url, secret_refs
+
+INDEX_FILE = os.getenv("SECRET_INDEX_FILE", "secret_index.json")
+INDEX_KINDS = list(KINDS) + ["Secret"]
+# Сколько секунд держим watch открытым: события после resourceVersion приходят сразу
+WATCH_SECONDS = 5
+# Секреты этих типов никто не монтирует, в отчёт о неиспользуемых они не попадают
+UNUSED_IGNORE_TYPES = {"kubernetes.io/service-account-token", "helm.sh/release.v1"}
+
+
+def object_key(kind, obj):
+    metadata = obj.get("metadata") or {}
+    if kind == "Secret":
+        return f"{metadata.get('namespace', '')}/{metadata.get('name')}"
+    return f"{kind}/{metadata.get('namespace', '')}/{metadata.get('name')}"
+
+
+class SecretIndex:
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {}
+        # "Kind/namespace/имя" -> {"resourceVersion", "refs": [[секрет, откуда ссылка], ...]}
+        self.objects = data.get("objects", {})
+        # "namespace/секрет" -> {"resourceVersion", "type"} (содержимое секретов не хранится)
+        self.secrets = data.get("secrets", {})
+        # Вид -> resourceVersion, с которого читать watch при следующем refresh
+        self.list_versions = data.get("list_versions", {})
+        # "namespace/секрет" -> [[объект, откуда ссылка], ...], строится при сохранении
+        self.consumers = data.get("consumers", {})
+        self.stats = {"changed": 0, "deleted": 0, "unchanged": 0}
+
+    # === Изменения ===
+    def upsert(self, kind, obj):
+        key = object_key(kind, obj)
+        version = (obj.get("metadata") or {}).get("resourceVersion")
+        entries = self.secrets if kind == "Secret" else self.objects
+        if version and entries.get(key, {}).get("resourceVersion") == version:
+            self.stats["unchanged"] += 1
+            return key
+        if kind == "Secret":
+            entries[key] = {"resourceVersion": version, "type": obj.get("type")}
+        else:
+            namespace = (obj.get("metadata") or {}).get("namespace", "")
+            refs = sorted([f"{namespace}/{name}", source] for name, source in secret_refs(obj))
+            entries[key] = {"resourceVersion": version, "refs": refs}
+        self.stats["changed"] += 1
+        return key
+
+    def delete(self, kind, obj):
+        entries = self.secrets if kind == "Secret" else self.objects
+        if entries.pop(object_key(kind, obj), None) is not None:
+            self.stats["deleted"] += 1
+
+    def keys_of_kind(self, kind):
+        if kind == "Secret":
+            return set(self.secrets)
+        return {key for key in self.objects if key.split("/", 1)[0] == kind}
+
+    # Полное чтение вида: всё, чего не оказалось в списке, удалено из кластера
+    def replace_kind(self, kind, objects, list_version=None):
+        seen = {self.upsert(kind, obj) for obj in objects}
+        for key in self.keys_of_kind(kind) - seen:
+            (self.secrets if kind == "Secret" else self.objects).pop(key)
+            self.stats["deleted"] += 1
+        if list_version:
+            self.list_versions[kind] = list_version
+        else:
+            self.list_versions.pop(kind, None)
+
+    def save(self):
+        consumers = {}
+        for owner, entry in self.objects.items():
+            for secret, source in entry["refs"]:
+                consumers.setdefault(secret, []).append([owner, source])
+        self.consumers = {secret: sorted(users) for secret, users in sorted(consumers.items())}
+        data = {
+            "objects": self.objects,
+            "secrets": self.secrets,
+            "list_versions": self.list_versions,
+            "consumers": self.consumers,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
+
+    # === Запросы ===
+    def who_uses(self, secret):
+        return self.consumers.get(secret, [])
+
+    def uses(self, owner):
+        return (self.objects.get(owner) or {}).get("refs", [])
+
+    def unused(self):
+        return sorted(secret for secret, entry in self.secrets.items()
+                      if secret not in self.consumers and entry.get("type") not in UNUSED_IGNORE_TYPES)
+
+    def missing(self):
+        """Секреты, на которые ссылаются объекты, но которых нет в кластере."""
+        return sorted(secret for secret in self.consumers if secret not in self.secrets)
+
+
+# === Чтение кластера ===
+def relist(kind, context=None):
+    """Все объекты вида постранично и resourceVersion списка (общий для всех страниц)."""
+    objects = []
+    continue_token = None
+    list_version = None
+    while True:
+        page = kubectl_raw(list_url(kind, None, CHUNK_SIZE, continue_token), context)
+        list_version = list_version or page.get("metadata", {}).get("resourceVersion")
+        for obj in page.get("items", []):
+            # Для секретов сразу отбрасываем содержимое, в памяти остаются только метаданные
+            objects.append({"metadata": obj["metadata"], "type": obj.get("type")} if kind == "Secret" else obj)
+        continue_token = page.get("metadata", {}).get("continue")
+        if not continue_token:
+            return objects, list_version
+
+
+def watch_url(kind, resource_version):
+    prefix, resource = API_PATHS[kind]
+    params = {"watch": 1, "resourceVersion": resource_version, "allowWatchBookmarks": "true",
+              "timeoutSeconds": WATCH_SECONDS}
+    return f"{prefix}/{resource}?{urllib.parse.urlencode(params)}"
+
+
+def watch_events(kind, resource_version, context=None):
+    """События после resourceVersion или None, если история уже недоступна (410 Gone)."""
+    cmd = ["kubectl", "get", "--raw", watch_url(kind, resource_version)]
+    if context:
+        cmd += ["--context", context]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        if "410" in result.stderr or "too old" in result.stderr:
+            return None
+        raise RuntimeError(f"kubectl get --raw {cmd[3]}: {result.stderr.strip()}")
+
+    events = []
+    decoder = json.JSONDecoder()
+    position = 0
+    output = result.stdout
+    while True:
+        while position < len(output) and output[position].isspace():
+            position += 1
+        if position >= len(output):
+            return events
+        event, position = decoder.raw_decode(output, position)
+        if event.get("type") == "ERROR":
+            if event.get("object", {}).get("code") == 410:
+                return None
+            raise RuntimeError(f"watch {kind}: {event.get('object', {}).get('message')}")
+        events.append(event)
+
+
+def fetch_kind(kind, resource_version, context=None):
+    """('watch', события, версия) или ('relist', объекты, версия)."""
+    if resource_version:
+        events = watch_events(kind, resource_version, context)
+        if events is not None:
+            versions = [e["object"].get("metadata", {}).get("resourceVersion") for e in events]
+            return "watch", events, next((v for v in reversed(versions) if v), resource_version)
+    objects, list_version = relist(kind, context)
+    return "relist", objects, list_version
+
+
+def refresh_from_cluster(index, context=None):
+    kinds = INDEX_KINDS
+    with ThreadPoolExecutor(max_workers=len(kinds)) as pool:
+        results = list(pool.map(lambda kind: fetch_kind(kind, index.list_versions.get(kind), context), kinds))
+
+    for kind, (mode, items, version) in zip(kinds, results):
+        if mode == "relist":
+            index.replace_kind(kind, items, version)
+        else:
+            for event in items:
+                if event["type"] in ("ADDED", "MODIFIED"):
+                    index.upsert(kind, event["object"])
+                elif event["type"] == "DELETED":
+                    index.delete(kind, event["object"])
+            index.list_versions[kind] = version
+        print(f"{kind}: {mode}, {len(items)} {'event(s)' if mode == 'watch' else 'object(s)'}", file=sys.stderr)
+
+
+# Из дампов kubectl get -o json: виды, попавшие в дамп, заменяются целиком
+def refresh_from_files(index, paths):
+    by_kind = {}
+    for path in paths:
+        for kind, obj in iter_dump_objects(path):
+            if kind in INDEX_KINDS:
+                if kind == "Secret":
+                    obj = {"metadata": obj.get("metadata", {}), "type": obj.get("type")}
+                by_kind.setdefault(kind, []).append(obj)
+    for kind, objects in by_kind.items():
+        index.replace_kind(kind, objects)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Индекс использования секретов в Kubernetes")
+    parser.add_argument("--index", default=INDEX_FILE, help="файл индекса")
+    commands = parser.add_subparsers(dest="command", required=True)
+    refresh = commands.add_parser("refresh", help="обновить индекс")
+    refresh.add_argument("--from-file", action="append", help="дамп kubectl get -o json вместо кластера")
+    refresh.add_argument("--context", help="контекст kubeconfig")
+    refresh.add_argument("--full", action="store_true", help="перечитать все виды целиком")
+    commands.add_parser("who-uses", help="кто использует секрет").add_argument("secret", help="namespace/секрет")
+    commands.add_parser("uses", help="какие секреты использует объект").add_argument("owner", help="Kind/namespace/имя")
+    commands.add_parser("unused", help="секреты, которые никто не использует")
+    commands.add_parser("missing", help="ссылки на несуществующие секреты")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    index = SecretIndex(args.index)
+
+    if args.command == "refresh":
+        if args.full:
+            index.list_versions = {}
+        try:
+            if args.from_file:
+                refresh_from_files(index, args.from_file)
+            else:
+                refresh_from_cluster(index, args.context)
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+        index.save()
+        print(f"Index updated: {len(index.objects)} object(s), {len(index.secrets)} secret(s), "
+              f"{index.stats['changed']} changed, {index.stats['deleted']} deleted, "
+              f"{index.stats['unchanged']} unchanged.", file=sys.stderr)
+    elif args.command == "who-uses":
+        for owner, source in index.who_uses(args.secret):
+            print(f"{owner}\t{source}")
+    elif args.command == "uses":
+        for secret, source in index.uses(args.owner):
+            print(f"{secret}\t{source}")
+    elif args.command == "unused":
+        for secret in index.unused():
+            print(secret)
+    elif args.command == "missing":
+        for secret in index.missing():
+            print(secret)
+
+
+if __name__ == "__main__":
+    main()